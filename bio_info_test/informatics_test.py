@@ -7,10 +7,14 @@ informatics_test
 Usage: informatics_test create_settings [<test_folder>]
        informatics_test create_folders [<test_folder>]
        informatics_test parse_students [<path_student_list_file>]
-       informatics_test generate_tests
+       informatics_test pregenerate_pool <n>
+       informatics_test generate_tests [--jobs=N] [--metrics-json=<path>] [--force]
+       informatics_test rerender_tests
        informatics_test rename_completed_tests [<returned_exam_folder>]      
-       informatics_test correct_tests [<question_numbers>...]
-       informatics_test generate_spreadsheet <correction_folder>
+       informatics_test correct_tests [--jobs=N] [--question-major] [--profile] [<question_numbers>...]
+       informatics_test watch [--jobs=N] [--interval=S]
+       informatics_test invalidate_grades <module>...
+       informatics_test generate_spreadsheet [--jobs=N] <correction_folder>
        informatics_test -h|--help
        informatics_test -v|--version
 
@@ -21,6 +25,15 @@ Arguments:
 Options:
     -h, --help      Show this screen.
     -v, --version   Show version.
+    -j N, --jobs=N  Number of worker processes [default: 1].
+    --metrics-json=<path>  Write the time spent in each phase for each student to a json file.
+    --force         Build new exams, with new variants, also for students whose exam
+                    exists but was made with other settings.
+    --question-major  Grade all answers to a question before the next question,
+                    within each batch of exams graded together.
+    --profile       Record the time and peak memory of every correct() call and
+                    write a report for each question module to the correction folder.
+    --interval=S    Seconds between checks of the returned exam folder [default: 2].
 """
 __version__="0.01"
 
@@ -32,15 +45,27 @@ import os
 import pathlib
 import docopt      # https://github.com/Infinidat/infi.docopt_completion/
 import time
-import subprocess
 import shelve
-import shutil
+import pickle
+import sqlite3
 import secrets
+import signal
 import collections
+import contextlib
+import copy
+import functools
+import importlib
+import itertools
+import json
+import concurrent.futures
+import multiprocessing
+import multiprocessing.connection
+import random
+import struct
 import textwrap
-from hashlib import md5
-import chardet
-from pyparsing import Literal, Word, nums, restOfLine, alphanums, Optional, LineEnd, SkipTo
+import tracemalloc
+import zlib
+from hashlib import md5, sha256
 from ezodf import newdoc, Sheet
 
 def parse_student_file(filename):
@@ -74,6 +99,213 @@ def parse_student_file(filename):
     return mecs,names
 
 
+def _seed_random(seed):
+    random.seed(seed)
+    if "numpy" in sys.modules:
+        sys.modules["numpy"].random.seed(seed)
+
+
+@functools.lru_cache(maxsize=4096)
+def _rebuild_question(module, qualname, points, seed):
+    # the question classes have to take all their randomness from the random
+    # module (or numpy.random) for the rebuilt variant to be the stored one
+    cls = importlib.import_module(module)
+    for name in qualname.split("."):
+        cls = getattr(cls, name)
+    _seed_random(seed)
+    return cls(points)
+
+
+class QuestionStore(object):
+    """Question objects pickled into an SQLite database.
+
+    Used like the shelf it replaces, store[question.id] = question and
+    store[question.id], but put_many inserts many questions in a single
+    transaction and records the mec of the student each question belongs
+    to. The database is kept in WAL mode so that it can be read while
+    another process writes to it.
+
+    Questions stored with a seed are not pickled, only their class, points
+    and the seed of the random generator they were made with are kept. They
+    are constructed again when read, at most once per process thanks to an
+    LRU cache.
+
+    With cache_size, the store keeps that many of the most recently read
+    questions unpickled, hits and misses count the lookups.
+    """
+
+    def __init__(self, path, readonly=False, cache_size=0):
+        self.path = pathlib.Path(path)
+        self.cache = collections.OrderedDict()
+        self.cache_size = cache_size
+        self.hits = self.misses = 0
+        if readonly:
+            self.connection = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, timeout=60)
+        else:
+            self.connection = sqlite3.connect(str(self.path), timeout=60)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            with self.connection:
+                self.connection.execute("CREATE TABLE IF NOT EXISTS questions ("
+                                        "id TEXT PRIMARY KEY, mec TEXT, module TEXT, data BLOB, "
+                                        "qualname TEXT, points, seed INTEGER)")
+                self.connection.execute("CREATE INDEX IF NOT EXISTS questions_mec ON questions (mec)")
+                self.connection.execute("CREATE TABLE IF NOT EXISTS pool ("
+                                        "seq INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT NOT NULL, data BLOB NOT NULL, "
+                                        "seed INTEGER)")
+                self.connection.execute("CREATE INDEX IF NOT EXISTS pool_key ON pool (key)")
+                self.connection.execute("CREATE TABLE IF NOT EXISTS grades ("
+                                        "question_id TEXT, version TEXT, answer TEXT, module TEXT, grade, comment, "
+                                        "PRIMARY KEY (question_id, version, answer))")
+                self.connection.execute("CREATE INDEX IF NOT EXISTS grades_module ON grades (module)")
+
+    def __getitem__(self, id):
+        if id in self.cache:
+            self.hits += 1
+            self.cache.move_to_end(id)
+            return self.cache[id]
+        self.misses += 1
+        question = self.load(id)
+        if self.cache_size:
+            self.cache[id] = question
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return question
+
+    def load(self, id):
+        row = self.connection.execute("SELECT data, module, qualname, points, seed FROM questions WHERE id = ?",
+                                      (id,)).fetchone()
+        if row is None:
+            raise KeyError(id)
+        data, module, qualname, points, seed = row
+        if data is None:
+            question = copy.copy(_rebuild_question(module, qualname, points, seed))
+            if question.id != id:
+                # the question id is not made from the seed
+                question.empty_question = question.empty_question.replace(question.id, id)
+                question.correct_answer = question.correct_answer.replace(question.id, id)
+                question.id = id
+            return question
+        return pickle.loads(data)
+
+    def __setitem__(self, id, question):
+        self.cache.pop(id, None)
+        self.put_many([(id, None, question, None)])
+
+    def __contains__(self, id):
+        return self.connection.execute("SELECT 1 FROM questions WHERE id = ?", (id,)).fetchone() is not None
+
+    def __len__(self):
+        return self.connection.execute("SELECT count(*) FROM questions").fetchone()[0]
+
+    def has_mec(self, mec):
+        """True if questions of the student with mec are stored."""
+        return self.connection.execute("SELECT 1 FROM questions WHERE mec = ? LIMIT 1", (mec,)).fetchone() is not None
+
+    def put_many(self, records):
+        """Store (question id, mec, question, seed) records in one transaction.
+
+        The question is pickled when seed is None.
+        """
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO questions VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                        ((id, mec, question.__class__.__module__,
+                                          pickle.dumps(question, pickle.HIGHEST_PROTOCOL), None, None, None)
+                                         if seed is None else
+                                         (id, mec, question.__class__.__module__,
+                                          None, question.__class__.__qualname__, question.points, seed)
+                                         for id, mec, question, seed in records))
+
+    def put_pool(self, key, variants):
+        """Add prebuilt (question variant, seed) pairs to the pool of key."""
+        with self.connection:
+            self.connection.executemany("INSERT INTO pool (key, data, seed) VALUES (?, ?, ?)",
+                                        ((key, pickle.dumps(variant, pickle.HIGHEST_PROTOCOL), seed)
+                                         for variant, seed in variants))
+
+    def draw_pool(self, keys):
+        """Remove and return one (variant, seed) pair from the pool of each key.
+
+        None is returned in place of a pair when a pool is empty.
+        """
+        variants = []
+        with self.connection:
+            for key in keys:
+                row = self.connection.execute("SELECT seq, data, seed FROM pool WHERE key = ? ORDER BY seq LIMIT 1",
+                                              (key,)).fetchone()
+                if row is None:
+                    variants.append(None)
+                else:
+                    self.connection.execute("DELETE FROM pool WHERE seq = ?", (row[0],))
+                    variants.append((pickle.loads(row[1]), row[2]))
+        return variants
+
+    def pool_size(self, key):
+        return self.connection.execute("SELECT count(*) FROM pool WHERE key = ?", (key,)).fetchone()[0]
+
+    def question_modules(self, ids):
+        """The module of the question class of each id, without unpickling."""
+        modules = {}
+        for id in ids:
+            row = self.connection.execute("SELECT module FROM questions WHERE id = ?", (id,)).fetchone()
+            if row:
+                modules[id] = row[0]
+        return modules
+
+    def cached_grades(self, keys):
+        """Look up (question id, grader version, answer checksum) keys.
+
+        Returns a dict of (grade, comment) for the keys graded before.
+        """
+        grades = {}
+        for key in keys:
+            row = self.connection.execute("SELECT grade, comment FROM grades "
+                                          "WHERE question_id = ? AND version = ? AND answer = ?", key).fetchone()
+            if row:
+                grades[key] = row
+        return grades
+
+    def put_grades(self, rows):
+        """Store (question id, grader version, answer checksum, module, grade, comment) rows."""
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO grades VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+    def invalidate_grades(self, module):
+        """Forget the cached grades of a question module, by full or last name."""
+        with self.connection:
+            return self.connection.execute("DELETE FROM grades WHERE module = ? OR module LIKE ?",
+                                           (module, "%." + module)).rowcount
+
+    def import_shelf(self, shelfpath, batch=1000):
+        """Copy all questions of a shelf made by an older version."""
+        with shelve.open(str(shelfpath), "r") as shelf:
+            records = []
+            for id in shelf.keys():
+                records.append((id, None, shelf[id], None))
+                if len(records) == batch:
+                    self.put_many(records)
+                    records = []
+            self.put_many(records)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_question_store(shelf_folder, readonly=False, cache_size=0):
+    storepath = pathlib.Path(shelf_folder) / "questions.sqlite"
+    shelfpath = pathlib.Path(shelf_folder) / "shelf.shelf"
+    if not storepath.exists() and list(pathlib.Path(shelf_folder).glob("shelf.shelf*")):
+        print(f"importing {shelfpath} into {storepath}")
+        with QuestionStore(storepath) as store:
+            store.import_shelf(shelfpath)
+    return QuestionStore(storepath, readonly=readonly, cache_size=cache_size)
+
+
 def create_settings(directory):
     settings_path = pathlib.Path("settings.py")
     if not settings_path.exists():
@@ -88,6 +320,25 @@ def create_settings(directory):
         student_list_file               = "students.txt"
         correction_folder               = "correction_"
         
+        # store only the class, points and random seed of each question variant
+        # and leave out the correct exams, the variants are rebuilt for correction
+        seed_only                       = False
+        
+        # when not 0, every question has this number of variants that are shared by
+        # the students, instead of a new variant for each student
+        variants_per_question           = 0
+        
+        # when not 0, correct_tests and watch grade each answer in a separate
+        # process and give up on answers needing more seconds or megabytes of
+        # memory than this, flagging them for manual grading
+        grading_timeout                 = 0
+        grading_memory_limit            = 0
+        
+        # which of several different exams returned by a student is corrected,
+        # "newest_mtime" (the file modified last) or "header_timestamp" (the
+        # largest timestamp in the header); the others go to returned_exam_folder/superseded
+        duplicate_policy                = "newest_mtime"
+        
         from bioinformatics_questions import (  blunt_cloning,
                                                 change_origin,
                                                 change_origin_rc,
@@ -205,7 +456,472 @@ def parse_students(student_list_file):
     print("# totally", len(mecs), "students")
     
 
-def generate_tests():
+_CRCTABLE = []
+for n in range(256):
+    c = n
+    for k in range(8):
+        c = (c >> 1) ^ 0xEDB88320 if c & 1 else c >> 1
+    _CRCTABLE.append(c)
+
+
+_KEYSTREAM = [((t * (t ^ 1)) >> 8) & 0xff for t in range(2, 0x10000, 4)]
+
+
+def _zipcrypto_encrypt(data, keys):
+    # Traditional PKWARE encryption, see APPNOTE.TXT section 6.1
+    k0, k1, k2 = keys
+    crctable = _CRCTABLE
+    keystream = _KEYSTREAM
+    out = bytearray(len(data))
+    for i, c in enumerate(data):
+        out[i] = c ^ keystream[(k2 & 0xffff) >> 2]
+        k0 = (k0 >> 8) ^ crctable[(k0 ^ c) & 0xff]
+        k1 = ((k1 + (k0 & 0xff)) * 134775813 + 1) & 0xffffffff
+        k2 = (k2 >> 8) ^ crctable[(k2 ^ (k1 >> 24)) & 0xff]
+    return bytes(out), (k0, k1, k2)
+
+
+@functools.lru_cache(maxsize=64)
+def _encrypt_member(data, password):
+    # The cipher runs in Python at roughly 0.8 s per MB of compressed data.
+    # The included files are the same in every exam and the password is the
+    # same for the whole class, so they are compressed and encrypted once
+    # per process and the same bytes are written to every archive.
+    crc = zlib.crc32(data)
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush()
+    keys = _zipcrypto_encrypt(password, (0x12345678, 0x23456789, 0x34567890))[1]
+    encryption_header, keys = _zipcrypto_encrypt(os.urandom(11) + bytes([crc >> 24]), keys)
+    compressed, keys = _zipcrypto_encrypt(compressed, keys)
+    return crc, encryption_header + compressed
+
+
+def write_encrypted_zip(path, members, password):
+    """Write a password protected zip archive.
+
+    members is an iterable of (name, bytes) pairs. The archive uses deflate
+    compression and the traditional zip encryption, the same format as
+    "7za a -tzip -p", so it can be opened by any unzip program. The archive
+    is written next to path and moved in place when complete, so path never
+    holds a partially written file.
+    """
+    path = pathlib.Path(path)
+    partial = path.with_name(path.name + ".part")
+    now = time.localtime()
+    dostime = now.tm_hour << 11 | now.tm_min << 5 | now.tm_sec // 2
+    dosdate = (now.tm_year - 1980) << 9 | now.tm_mon << 5 | now.tm_mday
+    password = password.encode()
+    central_directory = []
+    offset = 0
+
+    with open(partial, "wb") as f:
+        for name, data in members:
+            try:
+                encoded_name = name.encode("ascii")
+                flags = 0x1
+            except UnicodeEncodeError:
+                encoded_name = name.encode("utf-8")
+                flags = 0x1 | 0x800
+            crc, compressed = _encrypt_member(bytes(data), password)
+            compressed_size = len(compressed)
+            fields = (20, flags, 8, dostime, dosdate, crc, compressed_size, len(data), len(encoded_name))
+            f.write(struct.pack("<IHHHHHIIIHH", 0x04034b50, *fields, 0))
+            f.write(encoded_name)
+            f.write(compressed)
+            central_directory.append(struct.pack("<IHHHHHHIIIHHHHHII", 0x02014b50, 0x0314, *fields,
+                                                 0, 0, 0, 0, 0o100644 << 16, offset) + encoded_name)
+            offset += 30 + len(encoded_name) + compressed_size
+        entries = len(central_directory)
+        central_directory = b"".join(central_directory)
+        f.write(central_directory)
+        f.write(struct.pack("<IHHHHIIH", 0x06054b50, 0, 0, entries, entries,
+                            len(central_directory), offset, 0))
+    os.replace(partial, path)
+
+
+def _sha256_file(path):
+    h = sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _settings_digest(q, header, question_separator, endseparator, additional_included_files,
+                     variants_per_question):
+    # everything in settings.py that ends up in an exam
+    h = sha256(json.dumps([header, question_separator, endseparator, variants_per_question,
+                           [(question.__class__.__module__, question.__class__.__qualname__, question.points)
+                            for question in q]]).encode())
+    for path in additional_included_files:
+        h.update(str(path).encode())
+        h.update(pathlib.Path(path).read_bytes())
+    return h.hexdigest()
+
+
+def _outputs_intact(entry):
+    return all(pathlib.Path(path).exists() and _sha256_file(path) == checksum
+               for path, checksum in entry["outputs"].items())
+
+
+def read_manifest(shelf_folder):
+    """The generation manifest of shelf_folder.
+
+    For every exam it records a checksum of the inputs (roster row and the
+    exam related settings), the files written with their checksums and the
+    ids of the questions in the exam, together with the exam password.
+    """
+    manifest_path = pathlib.Path(shelf_folder) / "manifest.json"
+    if manifest_path.exists():
+        return json.loads(manifest_path.read_text())
+    return {"students": {}}
+
+
+def write_manifest(shelf_folder, manifest):
+    manifest_path = pathlib.Path(shelf_folder) / "manifest.json"
+    partial = manifest_path.with_name(manifest_path.name + ".part")
+    partial.write_text(json.dumps(manifest, indent=1))
+    os.replace(partial, manifest_path)
+
+
+class PhaseTimer(object):
+    """Wall clock time spent in named phases of the work for each student.
+
+    Phases are timed with
+
+        with timer.span(filename, "archive"):
+            ...
+
+    and time spent in the same phase for the same student is added up.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.timings = collections.defaultdict(lambda: collections.defaultdict(float))
+
+    @contextlib.contextmanager
+    def span(self, student, phase):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[student][phase] += time.perf_counter() - start
+
+    def add(self, student, timings):
+        """Add timings measured by another PhaseTimer, e.g. in a worker process."""
+        for phase, seconds in timings.items():
+            self.timings[student][phase] += seconds
+
+    def summary(self):
+        phases = collections.defaultdict(list)
+        for timings in self.timings.values():
+            for phase, seconds in timings.items():
+                phases[phase].append(seconds)
+        lines = ["{:<50} {:>10} {:>10} {:>10} {:>8}".format("phase", "total(s)", "mean(ms)", "max(ms)", "count")]
+        for phase, seconds in sorted(phases.items(), key=lambda item: -sum(item[1])):
+            lines.append("{:<50} {:>10.2f} {:>10.1f} {:>10.1f} {:>8}".format(phase,
+                                                                          sum(seconds),
+                                                                          1000*sum(seconds)/len(seconds),
+                                                                          1000*max(seconds),
+                                                                          len(seconds)))
+        lines.append("wall clock time {:.2f} s".format(time.perf_counter() - self.start))
+        return "\n".join(lines)
+
+    def write_json(self, path, **extra):
+        data = dict(extra,
+                    wall_clock=time.perf_counter() - self.start,
+                    students={student: dict(timings) for student, timings in self.timings.items()})
+        pathlib.Path(path).write_text(json.dumps(data, indent=1))
+
+
+def _init_generation_worker():
+    # forked workers inherit the parent's random state, reseed so that
+    # students in different workers do not get the same question variants
+    random.seed()
+    if "numpy" in sys.modules:
+        sys.modules["numpy"].random.seed()
+
+
+# whether the variants of a question class can be rebuilt from their seed,
+# found with the first variant of the class made by this process
+_rebuildable = {}
+
+
+def _new_variant(question, seed_only=False):
+    # returns the variant and the seed it was made with, if any
+    seed = secrets.randbits(32) if seed_only else None
+    if seed_only:
+        _seed_random(seed)
+    variant = copy.copy(question)
+    variant.__init__(variant.points)   # https://stackoverflow.com/questions/44178162/call-method-of-type-class
+    if seed_only:
+        # a class that does not take all its randomness from the random
+        # module (secrets, uuid, ...) cannot be rebuilt from the seed, its
+        # variants are stored whole
+        cls = variant.__class__
+        if cls not in _rebuildable:
+            # not through the lru_cache, the check object is not needed again
+            rebuilt = _rebuild_question.__wrapped__(cls.__module__, cls.__qualname__, variant.points, seed)
+            _rebuildable[cls] = (rebuilt.empty_question.replace(rebuilt.id, variant.id) == variant.empty_question and
+                                 rebuilt.correct_answer.replace(rebuilt.id, variant.id) == variant.correct_answer)
+        if not _rebuildable[cls]:
+            seed = None
+    return variant, seed
+
+
+def _pool_key(question):
+    return "{}.{}:{}".format(question.__class__.__module__, question.__class__.__qualname__, question.points)
+
+
+def _build_variants(question, count, seed_only):
+    return _pool_key(question), [_new_variant(question, seed_only) for n in range(count)]
+
+
+def _crlf(text):
+    # same as re.sub("\r?\n", "\r\n", text), but two passes of str.replace are much faster
+    return text.replace("\r\n", "\n").replace("\n", "\r\n")
+
+
+class ExamTemplate(object):
+    """The parts of an exam that are the same for every student.
+
+    The header, the separators and the additional included files are
+    converted to CRLF line endings once, when the template is made, so that
+    rendering an exam only has to convert the question texts.
+    """
+
+    def __init__(self, header, question_separator, endseparator, additional_included_files):
+        self.header = _crlf(header)
+        self.question_separator = _crlf(question_separator)
+        self.endseparator = _crlf(endseparator)
+        self.separators = []
+        self.included_files = {pathlib.Path(path).name: self.read_included_file(path)
+                               for path in additional_included_files}
+
+    @staticmethod
+    def read_included_file(path):
+        path = pathlib.Path(path)
+        if path.suffix in [".gb", ".txt"]:
+            return _crlf(path.read_text()).encode()
+        return path.read_bytes()
+
+    def separator(self, number):
+        while len(self.separators) < number:
+            self.separators.append(self.question_separator.format(len(self.separators) + 1))
+        return self.separators[number - 1]
+
+    def render(self, name, mec, timestamp, questions):
+        """Return the empty and the correct exam made of questions."""
+        header = self.header.format(name=name,
+                                    mec=mec,
+                                    timestamp=timestamp,
+                                    question_separator=self.question_separator,
+                                    number_of_questions=len(questions))
+        empty_exam = [header]
+        correct_exam = [header]
+        for number, question in enumerate(questions, 1):
+            separator = self.separator(number)
+            empty_exam.append(separator)
+            empty_exam.append(_crlf(question.empty_question))
+            correct_exam.append(separator)
+            correct_exam.append(_crlf(question.correct_answer))
+        empty_exam.append(self.endseparator)
+        correct_exam.append(self.endseparator)
+        return "".join(empty_exam), "".join(correct_exam)
+
+
+def _variant_number(mec, index, variants_per_question):
+    # the same student always gets the same variant, but students that share
+    # the variant of one question do not share the variants of the others
+    digest = sha256(f"{mec}:{index}".encode()).digest()
+    return int.from_bytes(digest[:8], "big") % variants_per_question
+
+
+def _generate_exam(student, variants, q, template, exam_folder, correct_exam_folder, password, seed_only):
+    """Generate the empty and correct exam for one student.
+
+    variants holds one prebuilt (variant, seed) pair for each question in
+    q, or None where a new variant has to be constructed. With seed_only
+    the correct exam is not written and the records carry the seeds the
+    variants were made with instead of having to be pickled.
+
+    Returns the exam filename, a list of (question id, mec, question, seed)
+    records that should be stored in the question store, the manifest
+    entry describing the files that were written and the time spent in
+    each phase. Several calls can run concurrently.
+
+    The archive is left unpublished, see _write_exam. It is moved in place
+    by _publish_exam once the records and the manifest entry are stored.
+    """
+    timestamp = int(time.time())
+    mec, name = student
+    filename = "{}_{}".format(name.replace(" ","_"),mec)
+
+    timer = PhaseTimer()
+
+    for index, question in enumerate(q):
+        if variants[index] is None:
+            with timer.span(filename, f"construct {question.__class__.__module__}"):
+                variants[index] = _new_variant(question, seed_only)
+
+    questions = [question for question, seed in variants]
+
+    records = [(question.id, mec, question, seed) for question, seed in variants]
+
+    entry = _write_exam(filename, name, mec, timestamp, questions, template,
+                        exam_folder, correct_exam_folder, password, seed_only, timer, publish=False)
+
+    return filename, records, entry, timer.timings[filename]
+
+
+def _unpublished(zip_path):
+    return pathlib.Path(zip_path).with_name(pathlib.Path(zip_path).name + ".new")
+
+
+def _publish_exam(exam_folder, filename):
+    zip_path = pathlib.Path(exam_folder) / f"{filename}.zip"
+    os.replace(_unpublished(zip_path), zip_path)
+
+
+def _write_exam(filename, name, mec, timestamp, questions, template,
+                exam_folder, correct_exam_folder, password, seed_only, timer, publish=True):
+    """Render, write and archive the exam made of questions.
+
+    The exam is archived directly from memory. Returns the manifest entry
+    describing the files that were written. Unless publish, the archive is
+    written next to its place with a .new suffix; the entry describes it
+    as it will be once _publish_exam has moved it in place.
+    """
+    with timer.span(filename, "render"):
+        empty_exam, correct_exam = template.render(name, mec, timestamp, questions)
+
+    members = {}
+
+    with timer.span(filename, "included files"):
+        for question in questions:
+            for path in question.included_files:
+                members[path.name] = template.read_included_file(path)
+
+    members.update(template.included_files)
+
+    outputs = []
+
+    if not seed_only:
+        with timer.span(filename, "write correct exam"):
+            correct_path = pathlib.Path("{exam_folder}/correct_{filename}.txt".format(exam_folder = correct_exam_folder, filename = filename))
+            with open(correct_path, "w", encoding="latin-1") as f:
+                f.write(correct_exam)
+            outputs.append(correct_path)
+
+    members["test_{filename}.txt".format(filename=filename)] = empty_exam.encode("latin-1")
+
+    zip_path = pathlib.Path(exam_folder) / f"{filename}.zip"
+
+    with timer.span(filename, "archive"):
+        write_encrypted_zip(zip_path if publish else _unpublished(zip_path), members.items(), password)
+
+    with timer.span(filename, "checksums"):
+        checksums = {str(path): _sha256_file(path) for path in outputs}
+        checksums[str(zip_path)] = _sha256_file(zip_path if publish else _unpublished(zip_path))
+        return {"timestamp" : timestamp,
+                "questions" : [question.id for question in questions],
+                "outputs"   : checksums}
+
+
+def pregenerate_pool(n):
+    settings_path = pathlib.Path("settings.py")
+    vardict= {}       
+    with open(settings_path) as f:
+        code = compile(f.read(), settings_path.name, 'exec')
+    exec(code, vardict)
+    q                         =vardict["q"]                       
+    shelf_folder              =vardict["shelf_folder"]       
+    seed_only                 =vardict.get("seed_only", False)
+
+    store = open_question_store(shelf_folder)
+
+    # a question can appear more than once in q, each time it needs its own variant
+    wanted = collections.Counter(_pool_key(question) for question in q)
+    templates = {_pool_key(question): question for question in q}
+
+    chunk = 10
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=os.cpu_count(),
+                                                initializer=_init_generation_worker) as executor:
+        futures = []
+        for key, question in templates.items():
+            missing = n * wanted[key] - store.pool_size(key)
+            print(f"{key}: {store.pool_size(key)} variants in pool, building {max(missing, 0)}")
+            for start in range(0, missing, chunk):
+                futures.append(executor.submit(_build_variants, question, min(chunk, missing - start), seed_only))
+        for future in concurrent.futures.as_completed(futures):
+            key, variants = future.result()
+            store.put_pool(key, variants)
+
+    for key in templates:
+        print(f"{key}: {store.pool_size(key)} variants in pool")
+
+    store.close()
+
+
+def rerender_tests():
+    settings_path = pathlib.Path("settings.py")
+    vardict= {}       
+    with open(settings_path) as f:
+        code = compile(f.read(), settings_path.name, 'exec')
+    exec(code, vardict)
+    q                         =vardict["q"]                       
+    shelf_folder              =vardict["shelf_folder"]       
+    additional_included_files =vardict["additional_included_files"] 
+    exam_folder               =vardict["exam_folder"]               
+    correct_exam_folder       =vardict["correct_exam_folder"]       
+    header                    =vardict["header"]                    
+    question_separator        =vardict["question_separator"]        
+    endseparator              =vardict["endseparator"]   
+    seed_only                 =vardict.get("seed_only", False)
+    variants_per_question     =vardict.get("variants_per_question", 0)
+
+    manifest = read_manifest(shelf_folder)
+
+    if not manifest["students"] or "password" not in manifest:
+        print(f"No exams found in {shelf_folder}/manifest.json, run generate_tests first.")
+        return
+
+    store = open_question_store(shelf_folder)
+
+    settings_digest = _settings_digest(q, header, question_separator, endseparator, additional_included_files,
+                                       variants_per_question)
+
+    template = ExamTemplate(header, question_separator, endseparator, additional_included_files)
+
+    timer = PhaseTimer()
+
+    signature = [(question.__class__.__module__, question.__class__.__qualname__, question.points) for question in q]
+
+    for filename, entry in manifest["students"].items():
+        with timer.span(filename, "store"):
+            questions = [store[id] for id in entry["questions"]]
+        if [(question.__class__.__module__, question.__class__.__qualname__, question.points)
+            for question in questions] != signature:
+            print(f"The questions of {filename} do not match settings.py, run generate_tests.")
+            continue
+        print(f"Rerendering {filename}")
+        entry.update(_write_exam(filename, entry["name"], entry["mec"], entry["timestamp"], questions, template,
+                                 exam_folder, correct_exam_folder, manifest["password"], seed_only, timer))
+        entry["inputs"] = sha256(json.dumps([settings_digest, entry["mec"], entry["name"]]).encode()).hexdigest()
+        write_manifest(shelf_folder, manifest)
+
+    if "shared_variants" in manifest:
+        manifest["shared_variants"]["inputs"] = settings_digest
+        write_manifest(shelf_folder, manifest)
+
+    print(timer.summary())
+
+    store.close()
+    input(f"password = {manifest['password']}")
+
+
+def generate_tests(jobs=1, metrics_json=None, force=False):
     settings_path = pathlib.Path("settings.py")
     vardict= {}       
     with open(settings_path) as f:
@@ -222,138 +938,349 @@ def generate_tests():
     header                    =vardict["header"]                    
     question_separator        =vardict["question_separator"]        
     endseparator              =vardict["endseparator"]   
+    seed_only                 =vardict.get("seed_only", False)
+    variants_per_question     =vardict.get("variants_per_question", 0)
     
     mecs, names = parse_student_file(vardict["student_list_file"])
     
     studentlist = list(zip(mecs,names))
     
-    shelfpath = pathlib.Path(shelf_folder) / "shelf.shelf"
-    
-    shelf = shelve.open(str(shelfpath))
-    
+    store = open_question_store(shelf_folder)
+
+    manifest = read_manifest(shelf_folder)
 
     alphabet = string.ascii_lowercase + string.digits
-    password = ''.join(secrets.choice(alphabet) for i in range(5))
-    
+    password = manifest.setdefault("password", ''.join(secrets.choice(alphabet) for i in range(5)))
+
+    settings_digest = _settings_digest(q, header, question_separator, endseparator, additional_included_files,
+                                       variants_per_question)
+
+    pending = {}
+
     for student in studentlist:
-        timestamp = int(time.time())
         mec, name = student
         filename = "{}_{}".format(name.replace(" ","_"),mec)
-        print(f"Preparing {filename}")
         exam_path = pathlib.Path(exam_folder)/filename
-        if exam_path.with_suffix(".zip").exists():
-            print(f"{exam_path} already exists, skipping.")
+        inputs = sha256(json.dumps([settings_digest, mec, name]).encode()).hexdigest()
+        entry = manifest["students"].get(filename)
+        if entry is None and exam_path.with_suffix(".zip").exists():
+            if store.has_mec(mec):
+                print(f"{exam_path} already exists but is not in the manifest, skipping.")
+                continue
+            # its questions were never stored, it could not be graded
+            print(f"{exam_path} has no questions in {shelf_folder}, writing it again.")
+        if entry and entry["inputs"] == inputs and _outputs_intact(entry):
+            print(f"{exam_path} is up to date, skipping.")
             continue
-        
-        empty_exam = header.format( name=name,
-                                    mec=mec,
-                                    timestamp=timestamp,
-                                    question_separator=question_separator,
-                                    number_of_questions=len(q) )
-    
-        correct_exam = empty_exam
-    
-        exam_included_files = []
-        
-        for i in q:
-            i.__init__(i.points)   # https://stackoverflow.com/questions/44178162/call-method-of-type-class
-    
-        for index, question in enumerate(q):
-            empty_exam += question_separator.format(index+1)
-            correct_exam += question_separator.format(index+1)
-            empty_exam += question.empty_question
-            correct_exam += question.correct_answer
-            shelf[question.id] = question
-            exam_included_files.extend(question.included_files)
-    
-        empty_exam   += endseparator
-        correct_exam += endseparator
-    
-        empty_exam   = re.sub("\r?\n", "\r\n", empty_exam)
-        correct_exam = re.sub("\r?\n", "\r\n", correct_exam)
-    
-        tempdir = pathlib.Path("/tmp/exam")
-        
-        if os.path.exists("/tmp/exam"):
-            shutil.rmtree("/tmp/exam")
-    
-        tempdir.mkdir(exist_ok=True)
-    
-        for path in exam_included_files + [pathlib.Path (f) for f in additional_included_files]:
-            newpath = pathlib.Path("/tmp/exam").joinpath(path.name)
-            if path.suffix in [".gb", ".txt"]:
-                text = re.sub("\r?\n", "\r\n", path.read_text())
-                newpath.write_text(text)
-            else:
-                shutil.copy(path, newpath)
-    
-        with open("{exam_folder}/correct_{filename}.txt".format(exam_folder = correct_exam_folder, filename = filename), "w", encoding="latin-1") as f:
-            f.write(correct_exam)
-    
-        with open("/tmp/exam/test_{filename}.txt".format(filename=filename), "w", encoding="latin-1") as f:
-            f.write( empty_exam)
-            
-        #shutil.rmtree(os.path.join(exam_folder, filename), ignore_errors=True)
-        #shutil.copytree("/tmp/exam/", os.path.join(exam_folder, filename))
-        
-        cmd = f'/home/bjorn/anaconda3/envs/EXAM/bin/7za a -tzip "/tmp/{filename}.zip" /tmp/exam/* -p{password} -scrcSHA256'
-        
-        slask=subprocess.call(cmd, shell=True)
-        for n in range(10):
+        if entry and exam_path.with_suffix(".zip").exists() and not force:
+            # the exam may have been handed out already, it keeps its questions
+            print(f"{exam_path} was made with other settings or was changed, skipping. "
+                  "Run rerender_tests to write it again with the same questions, "
+                  "or generate_tests --force for new questions.")
+            continue
+        pending[student] = inputs
+
+    template = ExamTemplate(header, question_separator, endseparator, additional_included_files)
+
+    arguments = (q, template, exam_folder, correct_exam_folder, password, seed_only)
+
+    built_live = 0
+
+    timer = PhaseTimer()
+
+    shared = []
+
+    shared_ids = set()
+
+    if variants_per_question and pending:
+        # Each question gets variants_per_question variants that are shared
+        # by the students. They are kept in the store once, without a mec.
+        recorded = manifest.get("shared_variants", {})
+        if recorded.get("inputs") == settings_digest and all(id in store for ids in recorded["questions"] for id in ids):
+            shared = [[(store[id], None) for id in ids] for ids in recorded["questions"]]
+        else:
+            print(f"Building {variants_per_question} variants of each question")
+            for index, question in enumerate(q):
+                with timer.span("shared variants", f"construct {question.__class__.__module__}"):
+                    variants = [variant for variant in store.draw_pool([_pool_key(question)] * variants_per_question)
+                                if variant is not None]
+                    variants.extend(_new_variant(question, seed_only) for n in range(variants_per_question - len(variants)))
+                store.put_many((variant.id, None, variant, seed) for variant, seed in variants)
+                shared.append(variants)
+            manifest["shared_variants"] = {"inputs"    : settings_digest,
+                                           "questions" : [[variant.id for variant, seed in variants] for variants in shared]}
+            write_manifest(shelf_folder, manifest)
+        shared_ids = {variant.id for variants in shared for variant, seed in variants}
+
+    def draw(student):
+        nonlocal built_live
+        mec, name = student
+        if shared:
+            return [variants[_variant_number(mec, index, variants_per_question)]
+                    for index, variants in enumerate(shared)]
+        with timer.span("{}_{}".format(name.replace(" ","_"),mec), "pool"):
+            variants = store.draw_pool([_pool_key(question) for question in q])
+        built_live += variants.count(None)
+        return variants
+
+    def finish(student, filename, records, entry, timings):
+        # The questions and the manifest entry are stored before the archive
+        # is moved in place, so an exam that can be handed out can always be
+        # graded. If this is interrupted, the next run writes the exam again.
+        mec, name = student
+        timer.add(filename, timings)
+        with timer.span(filename, "store"):
+            # questions of earlier versions of the exam are kept, they may
+            # still be returned
+            store.put_many(record for record in records if record[0] not in shared_ids)
+        with timer.span(filename, "manifest"):
+            entry.update(inputs=pending[student], name=name, mec=mec)
+            manifest["students"][filename] = entry
+            write_manifest(shelf_folder, manifest)
+        _publish_exam(exam_folder, filename)
+
+    if jobs > 1:
+        # The workers only build and archive the exams, the question store
+        # and the manifest are only ever written by this process.
+        # Only a few exams are submitted ahead of the workers, so that on
+        # ctrl-c or an error the rest of the class is not built in the
+        # background by the executor shutdown.
+        students = iter(pending)
+        futures = {}
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs,
+                                                    initializer=_init_generation_worker) as executor:
             try:
-                shutil.move(f"/tmp/{filename}.zip", exam_folder)
-            except FileNotFoundError:
-                time.sleep(0.1)
-            else:
-                break
-            
-    shelf.close()
+                while True:
+                    for student in itertools.islice(students, 2 * jobs - len(futures)):
+                        futures[executor.submit(_generate_exam, student, draw(student), *arguments)] = student
+                    if not futures:
+                        break
+                    done, running = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        filename, records, entry, timings = future.result()
+                        print(f"Prepared {filename}")
+                        finish(futures.pop(future), filename, records, entry, timings)
+            except BaseException:
+                # shutdown(cancel_futures=True) needs Python 3.9
+                for future in futures:
+                    future.cancel()
+                raise
+    else:
+        for student in pending:
+            mec, name = student
+            print("Preparing {}_{}".format(name.replace(" ","_"),mec))
+            finish(student, *_generate_exam(student, draw(student), *arguments))
+
+    if built_live:
+        print(f"{built_live} question variants were not found in the pool and had to be constructed.")
+
+    if pending:
+        print(timer.summary())
+
+    if metrics_json:
+        timer.write_json(metrics_json, jobs=jobs)
+
+    store.close()
     input(f"password = {password}")
 
  
 
 
-def rename_completed_tests():
+# only this much of the start of a returned exam is searched for the name and mec
+_HEADER_BYTES = 65536
+_NAME_FIELD   = re.compile(rb"Nome([^\n]*)")
+_MEC_FIELD    = re.compile(rb"\(mec\)([^\n]*)")
+# a returned exam renamed to name_mec_md5.txt
+_MD5_FILENAME = re.compile(r"_([a-fA-F\d]{32})\.(txt|TXT)$")
 
-    settings_path = pathlib.Path("settings.py")
-    vardict= {}       
-    with open(settings_path) as f:
-        code = compile(f.read(), settings_path.name, 'exec')
-    exec(code, vardict)               
-    returned_exam_folder  =vardict["returned_exam_folder"]         
 
-    cw = os.getcwd()
+def _read_exam_header(path, chunk_size=2**20):
+    """Read the name and mec from the header of a returned exam.
 
-    os.chdir(returned_exam_folder)
+    Only the first _HEADER_BYTES are searched, but the whole file is
+    hashed while it is read. Returns the name, the mec in lower case (None
+    for fields not found) and the md5 of the file.
+    """
+    h = md5()
+    with open(path, "rb") as f:
+        header = f.read(_HEADER_BYTES)
+        h.update(header)
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    name = _NAME_FIELD.search(header)
+    mec = _MEC_FIELD.search(header)
+    return (name and name.group(1).decode("latin-1").strip(),
+            mec and mec.group(1).decode("latin-1").strip().lower(),
+            h.hexdigest())
 
 
-    
+def read_hash_index(shelf_folder):
+    """The hash index of the returned exams.
+
+    For every returned exam read before that still has its original name,
+    it records the size and modification time (ns) of the file, its md5
+    and the name and mec in its header, by file name. These are the exams
+    that could not be renamed, e.g. for lack of a name or mec, which would
+    otherwise be hashed again by every run of watch.
+    """
+    index_path = pathlib.Path(shelf_folder) / "hash_index.json"
+    if index_path.exists():
+        return json.loads(index_path.read_text())
+    return {}
+
+
+def write_hash_index(shelf_folder, index):
+    index_path = pathlib.Path(shelf_folder) / "hash_index.json"
+    partial = index_path.with_name(index_path.name + ".part")
+    partial.write_text(json.dumps(index, indent=1))
+    os.replace(partial, index_path)
+
+
+def _exam_headers(folder, filenames, index):
+    """The name, mec and md5 of each file, by file name.
+
+    Files whose size and modification time match their entry in the hash
+    index are not read again. The others are read in a thread pool, as
+    hashlib lets other threads run while it hashes, and are added to the
+    index. Returns the headers and whether the index changed.
+    """
+    stale = []
+    for filename in filenames:
+        stat = os.stat(os.path.join(folder, filename))
+        if index.get(filename, [None, None])[:2] != [stat.st_size, stat.st_mtime_ns]:
+            stale.append((filename, stat))
+    with concurrent.futures.ThreadPoolExecutor() as pool:
+        for (filename, stat), header in zip(stale, pool.map(_read_exam_header,
+                                                            [os.path.join(folder, f) for f, stat in stale])):
+            index[filename] = [stat.st_size, stat.st_mtime_ns] + list(header)
+    return {filename: tuple(index[filename][2:]) for filename in filenames}, bool(stale)
+
+
+def _fsync_directory(folder):
+    # makes renames in folder durable
+    if hasattr(os, "O_DIRECTORY"):
+        fd = os.open(folder, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def _apply_renames(folder, renames):
+    """Rename (old, new) file name pairs in folder, skipping those already
+    done. Renames that are no longer possible are skipped and reported.
+    """
+    for old, new in renames:
+        old, new = os.path.join(folder, old), os.path.join(folder, new)
+        if os.path.exists(old) and os.path.exists(new):
+            print("not renaming", old, "to", new, "which exists")
+        elif os.path.exists(old):
+            os.makedirs(os.path.dirname(new), exist_ok=True)
+            os.rename(old, new)
+        elif not os.path.exists(new):
+            print("not renaming", old, "to", new, "as it is gone")
+    _fsync_directory(folder)
+
+
+def _recover_renames(folder, shelf_folder):
+    """Finish or undo a batch of renames that was interrupted.
+
+    The batch is resumed if every file is still found under its old or its
+    new name. Otherwise the folder changed since the renames were planned,
+    and the renames already done are rolled back.
+    """
+    journal_path = pathlib.Path(shelf_folder) / "rename_journal.json"
+    if not journal_path.exists():
+        return
+    renames = json.loads(journal_path.read_text())
+    if all(os.path.exists(os.path.join(folder, old)) or os.path.exists(os.path.join(folder, new))
+           for old, new in renames):
+        print(f"resuming {len(renames)} interrupted renames in {folder}")
+        _apply_renames(folder, renames)
+    else:
+        print(f"rolling back {len(renames)} interrupted renames in {folder}")
+        _apply_renames(folder, [(new, old) for old, new in renames])
+    journal_path.unlink()
+
+
+_HEADER_TIMESTAMP = re.compile(rb"timestamp\s+(\d+)", re.I)
+
+
+def _free_name(folder, name, taken):
+    """name, or name with a counter before the extension, such that it is
+    neither a file in folder nor one of the names in taken.
+    """
+    stem, extension = os.path.splitext(name)
+    candidate, n = name, 1
+    while candidate in taken or os.path.exists(os.path.join(folder, candidate)):
+        candidate = f"{stem}_{n}{extension}"
+        n += 1
+    return candidate
+
+
+def _newest(folder, filenames, duplicate_policy):
+    """The file to keep out of several versions of an exam from the same mec.
+
+    duplicate_policy "newest_mtime" keeps the file modified last,
+    "header_timestamp" the one with the largest timestamp in its header,
+    then the one modified last.
+    """
+    def key(filename):
+        path = os.path.join(folder, filename)
+        timestamp = 0
+        if duplicate_policy == "header_timestamp":
+            with open(path, "rb") as f:
+                found = _HEADER_TIMESTAMP.search(f.read(_HEADER_BYTES))
+            timestamp = int(found.group(1)) if found else 0
+        elif duplicate_policy != "newest_mtime":
+            raise ValueError(f"unknown duplicate_policy {duplicate_policy!r}")
+        return timestamp, os.stat(path).st_mtime_ns, filename
+    return max(filenames, key=key)
+
+
+def _rename_returned_exams(returned_exam_folder, shelf_folder, duplicate_policy="newest_mtime"):
+    """Rename the returned exams to name_mec_md5.txt.
+
+    The name and mec are read from the header of each exam. Files already
+    named with their md5 are left alone. The hash index in shelf_folder is
+    kept up to date. Returns the new file names.
+
+    Only one exam per student is left in the folder. Files with the same
+    md5 as another are moved to the duplicates subfolder. Of several
+    different exams with the same mec, one is kept by duplicate_policy
+    (see _newest) and the rest are moved to the superseded subfolder.
+
+    All renames and moves are written to a journal in shelf_folder before
+    the first one is made, so that a batch interrupted by a crash is
+    finished or rolled back by the next call.
+    """
+    _recover_renames(returned_exam_folder, shelf_folder)
+
     lst =[]
+
+    filenames = sorted(os.listdir(returned_exam_folder))
+    index = read_hash_index(shelf_folder)
+    unindexed = [filename for filename in index if filename not in filenames]
+    for filename in unindexed:
+        del index[filename]
+
+    headers, changed = _exam_headers(returned_exam_folder,
+                                     [filename for filename in filenames
+                                      if os.path.splitext(filename)[1].lower() == ".txt"
+                                      and not _MD5_FILENAME.search(filename)],
+                                     index)
+
+    # file name in the folder of every exam after renaming, by the name it has now
+    final = {filename: filename for filename in filenames if _MD5_FILENAME.search(filename)}
     
-    for filename in sorted(os.listdir(".")):
+    for filename in sorted(headers):
     
-        f, e = os.path.splitext(filename)
-        if e.lower()!=".txt":
+        parsed_student_name, parsed_mec, md5_ = headers[filename]
+
+        if parsed_student_name is None or parsed_mec is None:
+            print("no name or mec found in the header of", filename)
             continue
     
-        handle = codecs.open(filename,"rb", "latin-1")
-        exam = handle.read()
-        handle.close()
-    
-        md5_ = md5(exam.encode("latin-1")).hexdigest()
-    
-        name      = (Literal("Nome") +
-                     SkipTo(LineEnd()).setResultsName("name"))
-    
-        id        = (Literal("(mec)") +
-                     SkipTo(LineEnd()).setResultsName("mec"))
-    
-        for data,dataStart,dataEnd in name.scanString(exam):
-            parsed_student_name = data["name"].strip()
-    
-        for data,dataStart,dataEnd in id.scanString(exam):
-            parsed_mec  = data["mec"].strip().lower()
-    
         mec_in_filename = re.search("[\d|A|a|e|E]\d{4,5}",filename)
         if mec_in_filename:
             mec_in_filename = mec_in_filename.group()
@@ -361,21 +1288,599 @@ def rename_completed_tests():
                 parsed_mec=mec_in_filename.lower()
                 
         new_name = parsed_student_name.replace(" ","_")+"_"+parsed_mec+"_"+md5_+".txt"
-    
-        #if unicode(filename,"utf-8") != new_name:
-        if not re.search("_([a-fA-F\d]{32})\.(txt|TXT)", filename):
+
+        final[filename] = new_name
+
+    moves = {}
+    by_md5 = collections.defaultdict(list)
+    by_mec = collections.defaultdict(list)
+    for filename, new_name in sorted(final.items()):
+        by_md5[_MD5_FILENAME.search(new_name).group(1).lower()].append(filename)
+    for md5_, same in by_md5.items():
+        # md5 named files first, so that exams already renamed stay
+        same.sort(key=lambda filename: (final[filename] != filename, filename))
+        for filename in same[1:]:
+            print("duplicate", filename, "of", final[same[0]])
+            # mail clients reuse attachment names, an earlier duplicate
+            # may already have this name
+            moves[filename] = _free_name(returned_exam_folder, os.path.join("duplicates", filename),
+                                         set(moves.values()))
+        # the mec is the part of the name before the md5
+        name, separator, mec = final[same[0]][:_MD5_FILENAME.search(final[same[0]]).start()].rpartition("_")
+        by_mec[mec.lower() if separator and mec else final[same[0]]].append(same[0])
+    for mec, versions in by_mec.items():
+        if len(versions) > 1:
+            keep = _newest(returned_exam_folder, versions, duplicate_policy)
+            for filename in versions:
+                if filename != keep:
+                    print("superseded", filename, "by", final[keep])
+                    moves[filename] = _free_name(returned_exam_folder, os.path.join("superseded", final[filename]),
+                                                 set(moves.values()))
+
+    for filename in sorted(headers):
+        if filename in final and filename not in moves:
             print("rename",filename, end=' ')
-            print("to",     new_name)
-            lst.append((filename, new_name))
-    
+            print("to",     final[filename])
+            lst.append((filename, final[filename]))
+    lst.extend(sorted(moves.items()))
+
+    journal_path = pathlib.Path(shelf_folder) / "rename_journal.json"
+    if lst:
+        partial = journal_path.with_name(journal_path.name + ".part")
+        with open(partial, "w") as f:
+            json.dump(lst, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(partial, journal_path)
+        _fsync_directory(shelf_folder)
+
+    _apply_renames(returned_exam_folder, lst)
 
     for filename, newname in lst:
-        os.rename(filename, newname)
-        
-    os.chdir(cw)
+        # md5 named files are never read again, only exams that could not
+        # be renamed are worth keeping in the index
+        index.pop(filename, None)
+
+    if changed or unindexed or lst:
+        write_hash_index(shelf_folder, index)
+
+    if lst:
+        journal_path.unlink()
+
+    return [newname for filename, newname in lst if filename not in moves]
+
+
+def rename_completed_tests():
+
+    settings_path = pathlib.Path("settings.py")
+    vardict= {}       
+    with open(settings_path) as f:
+        code = compile(f.read(), settings_path.name, 'exec')
+    exec(code, vardict)               
+    returned_exam_folder  =vardict["returned_exam_folder"]         
+    shelf_folder          =vardict["shelf_folder"]
+    duplicate_policy      =vardict.get("duplicate_policy", "newest_mtime")
+
+    _rename_returned_exams(returned_exam_folder, shelf_folder, duplicate_policy)
 
     
-def correct_tests(question_numbers):
+class ExamTokenizer(object):
+    """Finds the header fields and the answers of a returned exam.
+
+    The patterns are compiled once. tokenize() searches the header fields
+    only in the text before the first QuestionID and walks the rest of the
+    text once, returning offsets instead of copies of the answers.
+    """
+
+    def __init__(self, uuidpat):
+        self.question_id = re.compile(uuidpat)
+        self.name = re.compile("(Name|Nome)(.*?)$", re.M)
+        self.mec = re.compile("^(Número mecanográfico \\(mec\\))(.*?)$", re.M)
+
+    def tokenize(self, text):
+        """Return the name, the mec and a list of
+        (id_start, id_end, answer_start, answer_end) offsets into text.
+
+        An answer runs until the next QuestionID, the last one until the end
+        of the text, not counting a final newline.
+        """
+        ids = [match.span() for match in self.question_id.finditer(text)]
+        header_end = ids[0][0] if ids else len(text)
+        name = self.name.search(text, 0, header_end).group(2).strip()
+        mec = self.mec.search(text, 0, header_end).group(2).strip()
+        end = len(text) - 1 if text.endswith("\n") else len(text)
+        answer_ends = [start for start, stop in ids[1:]] + [max(end, stop) for start, stop in ids[-1:]]
+        spans = [(start, stop, stop, answer_end) for (start, stop), answer_end in zip(ids, answer_ends)]
+        return name, mec, spans
+
+    @staticmethod
+    def answers(text, spans):
+        """Yield (question id, answer) for the spans returned by tokenize."""
+        for id_start, id_end, answer_start, answer_end in spans:
+            yield text[id_start:id_end], text[answer_start:answer_end]
+
+
+@functools.lru_cache(maxsize=None)
+def _exam_tokenizer(uuidpat):
+    return ExamTokenizer(uuidpat)
+
+
+_worker_store = None
+
+
+def _init_correction_worker(shelf_folder):
+    global _worker_store
+    # ctrl-c is handled by the main process, which stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _worker_store = open_question_store(shelf_folder, readonly=True, cache_size=1024)
+
+
+def _decode_exam(data, encoding=None):
+    """Decode a returned exam.
+
+    Tries, in order, the encoding found for the same file before, a byte
+    order mark, strict UTF-8 and latin-1, the encoding the exams are written
+    in. Text containing NUL or C1 control characters is unlikely to be
+    latin-1, for these chardet looks at the first 64 kB.
+
+    Returns the text, the encoding and which of the above found it.
+    """
+    if encoding:
+        try:
+            return data.decode(encoding), encoding, "cache"
+        except (UnicodeDecodeError, LookupError):
+            pass
+    for bom, encoding in ((codecs.BOM_UTF8, "utf-8-sig"),
+                          (codecs.BOM_UTF16_LE, "utf-16"),
+                          (codecs.BOM_UTF16_BE, "utf-16")):
+        if data.startswith(bom):
+            return data.decode(encoding), encoding, "bom"
+    try:
+        return data.decode("utf-8"), "utf-8", "utf-8"
+    except UnicodeDecodeError:
+        pass
+    if not re.search(b"[\x00\x80-\x9f]", data):
+        return data.decode("latin-1"), "latin-1", "latin-1"
+    import chardet  # only needed for the few exams that get here
+    encoding = chardet.detect(data[:65536])["encoding"] or "latin-1"
+    try:
+        return data.decode(encoding), encoding, "chardet"
+    except (UnicodeDecodeError, LookupError):
+        return data.decode("latin-1"), "latin-1", "chardet"
+
+
+_CORRECTION_TEMPLATE = textwrap.dedent('''
+        {sep1}
+        {correct_answer}
+        {sep2}
+        {students_answer}
+        {sep3}
+
+        automatic comments:
+        {comment}
+        manual comment:
+
+        question..........: {question_no:03d}
+        points............: {points}
+        name..............: {name}
+        mec...............: {mec}
+        automatic grade(%): {grade}
+        manual grade(%)...:
+        {sep4}
+        ''')
+
+
+def _correction(question_no, points, name, mec, correct_answer, answer, grade, comment):
+    return _CORRECTION_TEMPLATE.format( question_no     = question_no+1,
+                                        points          = points,
+                                        mec             = mec,
+                                        name            = name,
+                                        correct_answer  = correct_answer,
+                                        students_answer = answer,
+                                        grade           = grade,
+                                        comment         = comment,
+                                        sep1            = "^"*(79-15)+" CORRECT ANSWER",
+                                        sep2            = "="*(79-16)+" students answer",
+                                        sep3            = "_"*(79-11)+" correction",
+                                        sep4            = "~"*79,
+                                        )
+
+
+@functools.lru_cache(maxsize=None)
+def _grader_version(module):
+    # changes whenever the source of the question module changes
+    module = importlib.import_module(module)
+    h = sha256(str(getattr(module, "__version__", "")).encode())
+    if getattr(module, "__file__", None):
+        h.update(pathlib.Path(module.__file__).read_bytes())
+    return h.hexdigest()
+
+
+def _answer_digest(answer):
+    return sha256(answer.replace("\r\n", "\n").strip().encode()).hexdigest()
+
+
+def _parse_exam(path, uuidpat, encoding=None):
+    """Read, decode and tokenize one returned exam.
+
+    encoding is the encoding found for the same file in an earlier run, if
+    any. Returns the name and mec found in the exam header, the list of
+    (question id, answer) pairs and the encoding of the exam together with
+    how it was found.
+    """
+    with open(path, "rb") as f:
+        test = f.read()
+    test, encoding, detection = _decode_exam(test, encoding)
+    tokenizer = _exam_tokenizer(uuidpat)
+    name, mec, spans = tokenizer.tokenize(test)
+    return name, mec, list(tokenizer.answers(test, spans)), (encoding, detection)
+
+
+def _timed(function, *args, profile=False):
+    """Call function, returning its result and the wall and CPU seconds it
+    took. When profiling, the peak of memory allocated during the call, in
+    bytes, is traced as well; otherwise it is None.
+    """
+    if profile:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        # clearing the traces resets the peak, tracemalloc.reset_peak
+        # needs Python 3.9
+        tracemalloc.clear_traces()
+    start, cpu_start = time.perf_counter(), time.process_time()
+    result = function(*args)
+    seconds, cpu_seconds = time.perf_counter() - start, time.process_time() - cpu_start
+    peak = tracemalloc.get_traced_memory()[1] if profile else None
+    return result, (seconds, cpu_seconds, peak)
+
+
+def _grade_answers(answers, store=None, cached=None, profile=False):
+    """Grade a list of (question id, answer) pairs.
+
+    A question class can grade many answers in one call by implementing
+    correct_many(pairs) as a class or static method. It gets a list of
+    (question, answer) pairs and returns a (grade, comment) tuple for each,
+    just as correct(answer) would. Answers to classes without it are graded
+    one at a time.
+
+    cached holds a (grade, comment) tuple found in the grade cache, or None,
+    for each answer. Cached answers are not graded again.
+
+    Returns, for every answer, the module and points of the question, the
+    grade, the comment and the wall seconds, CPU
+    seconds and (when profiling) peak memory grading took, followed by the
+    number of question cache hits and misses. Answers graded together by
+    correct_many share the time evenly and the peak of the batch. store
+    defaults to the read only question store of a correction worker.
+    """
+    if store is None:
+        # not "store or", that would count the questions in the store
+        store = _worker_store
+    hits, misses = store.hits, store.misses
+    questions = [store[str(id)] for id, answer in answers]
+    batches = collections.defaultdict(list)
+    for index, questionobj in enumerate(questions):
+        batches[questionobj.__class__].append(index)
+    graded = [None] * len(answers)
+    for index, grade in enumerate(cached or []):
+        if grade is not None:
+            graded[index] = tuple(grade) + (0.0, 0.0, None)
+    for cls, indices in batches.items():
+        indices = [index for index in indices if graded[index] is None]
+        if not indices:
+            continue
+        correct_many = getattr(cls, "correct_many", None)
+        if correct_many is not None:
+            grades, (seconds, cpu_seconds, peak) = _timed(correct_many,
+                                                          [(questions[index], answers[index][1]) for index in indices],
+                                                          profile=profile)
+            grades = list(grades)
+            if len(grades) != len(indices):
+                raise ValueError(f"{cls.__module__}.{cls.__qualname__}.correct_many returned {len(grades)} "
+                                 f"grades for {len(indices)} answers")
+            for index, (grade, comment) in zip(indices, grades):
+                graded[index] = grade, comment, seconds / len(indices), cpu_seconds / len(indices), peak
+        else:
+            for index in indices:
+                (grade, comment), timing = _timed(questions[index].correct, answers[index][1], profile=profile)
+                graded[index] = (grade, comment) + timing
+    results = [(questionobj.__class__.__module__, questionobj.points) + grade
+               for questionobj, grade in zip(questions, graded)]
+    return results, (store.hits - hits, store.misses - misses)
+
+
+_MANUAL_GRADING = "NEEDS MANUAL GRADING"
+
+
+def _address_space():
+    # the current size of the address space of this process, in bytes
+    import resource
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[0]) * resource.getpagesize()
+
+
+def _budgeted_grader(connection, shelf_folder, memory_limit):
+    # grades one answer at a time for a GradingPool, until it gets None
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if memory_limit:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+    store = open_question_store(shelf_folder, readonly=True, cache_size=1024)
+    while True:
+        try:
+            message = connection.recv()
+        except EOFError:
+            break
+        if message is None:
+            break
+        id, answer, profile = message
+        try:
+            questionobj = store[str(id)]
+            if memory_limit:
+                # the budget comes on top of what the process (with the
+                # libraries it inherited or imported) already takes
+                limit = _address_space() + memory_limit * 2**20
+                resource.setrlimit(resource.RLIMIT_AS, (limit if hard == resource.RLIM_INFINITY else min(limit, hard), hard))
+            try:
+                (grade, comment), timing = _timed(questionobj.correct, answer, profile=profile)
+            finally:
+                if memory_limit:
+                    resource.setrlimit(resource.RLIMIT_AS, (soft, hard))
+        except MemoryError:
+            connection.send(("memory",))
+        except Exception as e:
+            connection.send(("error", repr(e)))
+        else:
+            connection.send(("graded", grade, comment) + timing)
+
+
+class GradingPool(object):
+    """Worker processes grading one answer at a time within a budget.
+
+    An answer whose correct() call runs for more than timeout seconds, or
+    needs more than memory_limit megabytes on top of what the worker
+    already uses, gets a grade of 0 and a comment
+    flagging it for manual grading. The worker is killed and replaced, so
+    that the other answers are graded as usual. A budget of 0 is no limit.
+    """
+
+    def __init__(self, shelf_folder, processes=1, timeout=0, memory_limit=0):
+        self.shelf_folder = shelf_folder
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self.workers = [self._start() for n in range(processes)]
+
+    def _start(self):
+        connection, child_connection = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=_budgeted_grader, daemon=True,
+                                          args=(child_connection, self.shelf_folder, self.memory_limit))
+        process.start()
+        child_connection.close()
+        return process, connection
+
+    def _replace(self, worker):
+        process, connection = worker
+        process.kill()
+        process.join()
+        connection.close()
+        self.workers.remove(worker)
+        worker = self._start()
+        self.workers.append(worker)
+        return worker
+
+    def grade(self, answers, profile=False):
+        """Grade (question id, answer) pairs.
+
+        Returns (grade, comment, wall seconds, CPU seconds, peak memory) for
+        each; answers over the budget have no CPU seconds or peak memory.
+        """
+        pending = collections.deque(enumerate(answers))
+        graded = [None] * len(answers)
+        idle = list(self.workers)
+        busy = {}
+        errors = []
+        while pending or busy:
+            while pending and idle:
+                worker = idle.pop()
+                index, (id, answer) = pending.popleft()
+                worker[1].send((str(id), answer, profile))
+                busy[worker[1]] = worker, index, time.perf_counter()
+            timeout = None
+            if self.timeout:
+                timeout = max(0, min(start for worker, index, start in busy.values()) + self.timeout - time.perf_counter())
+            for connection in multiprocessing.connection.wait(list(busy), timeout):
+                worker, index, start = busy.pop(connection)
+                try:
+                    outcome = connection.recv()
+                except EOFError:
+                    # the worker died, most likely when it ran out of memory
+                    outcome = ("memory",)
+                if outcome[0] == "error":
+                    # raised once the other workers are done, so that no
+                    # answer is left in a pipe
+                    errors.append(f"grading question {answers[index][0]} failed: {outcome[1]}")
+                    graded[index] = outcome
+                elif outcome[0] == "memory":
+                    graded[index] = (0, f"{_MANUAL_GRADING}: grading needed more than {self.memory_limit} MB",
+                                     time.perf_counter() - start, None, None)
+                    worker = self._replace(worker)
+                else:
+                    graded[index] = outcome[1:]
+                idle.append(worker)
+            now = time.perf_counter()
+            for connection, (worker, index, start) in list(busy.items()):
+                if self.timeout and now - start >= self.timeout:
+                    del busy[connection]
+                    graded[index] = (0, f"{_MANUAL_GRADING}: no grade after {self.timeout} s", now - start, None, None)
+                    idle.append(self._replace(worker))
+        if errors:
+            raise RuntimeError(errors[0])
+        return graded
+
+    def grade_answers(self, answers, store, cached=None, profile=False):
+        """Like _grade_answers, but every answer is graded alone, within the budget."""
+        hits, misses = store.hits, store.misses
+        questions = [store[str(id)] for id, answer in answers]
+        cached = cached or [None] * len(answers)
+        uncached = [index for index, grade in enumerate(cached) if grade is None]
+        graded = [None if grade is None else tuple(grade) + (0.0, 0.0, None) for grade in cached]
+        for index, grade in zip(uncached, self.grade([answers[index] for index in uncached], profile)):
+            graded[index] = grade
+        results = [(questionobj.__class__.__module__, questionobj.points) + grade
+                   for questionobj, grade in zip(questions, graded)]
+        return results, (store.hits - hits, store.misses - misses)
+
+    def close(self):
+        # the forked workers hold copies of the pipes, so they are told to
+        # stop instead of waiting for the end of the pipe
+        for process, connection in self.workers:
+            try:
+                connection.send(None)
+            except OSError:
+                pass
+            connection.close()
+        for process, connection in self.workers:
+            process.join(5)
+            if process.is_alive():
+                process.kill()
+                process.join()
+        self.workers = []
+
+
+def _grade_tasks(tasks, store, executor=None, jobs=1, question_major=False, pool=None, profile=False):
+    """Grade (question number, exam number, question id, answer) tasks.
+
+    Answers found in the grade cache of the store are not graded again,
+    new grades are added to it. The rest are graded in chunks, by the
+    GradingPool or the executor if there is one. Answers flagged for manual
+    grading are not cached.
+
+    Returns the results by (exam number, question number), the module,
+    question number, exam number, question id, wall seconds, CPU seconds
+    and peak memory of every answer graded now, the question cache hits
+    and misses and the number of answers found in the grade cache.
+    """
+    mapper = executor.map if executor else map
+    grader = _grade_answers
+    if pool is not None:
+        mapper = map
+        grader = pool.grade_answers
+
+    # grades of answers seen before, by question, grader version and answer
+    modules = store.question_modules({id for question_no, exam_no, id, answer in tasks})
+    keys = [(id, _grader_version(modules[id]), _answer_digest(answer)) if id in modules else None
+            for question_no, exam_no, id, answer in tasks]
+    cached_grades = store.cached_grades(key for key in keys if key)
+    tasks = [task + (key, cached_grades.get(key)) for task, key in zip(tasks, keys)]
+
+    if question_major:
+        # all answers to a question are graded one after the other, so the
+        # grader of each question module stays loaded
+        tasks.sort(key=lambda task: task[0])
+
+    # consecutive tasks are graded together, never mixing questions in
+    # question major order
+    size = max(1, len(tasks) // (4 * jobs))
+    chunks = []
+    for task in tasks:
+        if not chunks or len(chunks[-1]) == size or (question_major and chunks[-1][-1][0] != task[0]):
+            chunks.append([])
+        chunks[-1].append(task)
+
+    answer_lists = [[(id, answer) for question_no, exam_no, id, answer, key, cached in chunk] for chunk in chunks]
+    cached_lists = [[cached for question_no, exam_no, id, answer, key, cached in chunk] for chunk in chunks]
+
+    graded = {}
+    timings = []
+    cache = collections.Counter()
+    for chunk, (results, (hits, misses)) in zip(chunks, mapper(grader, answer_lists,
+                                                               itertools.repeat(None if executor and not pool else store),
+                                                               cached_lists,
+                                                               itertools.repeat(profile))):
+        cache.update(hits=hits, misses=misses)
+        new_grades = []
+        for (question_no, exam_no, id, answer, key, cached), result in zip(chunk, results):
+            graded[exam_no, question_no] = result
+            if cached is None:
+                timings.append((result[0], question_no, exam_no, id) + result[4:])
+                if key and not str(result[3]).startswith(_MANUAL_GRADING):
+                    new_grades.append(key + (result[0], result[2], result[3]))
+        store.put_grades(new_grades)
+
+    # answers found in the grade cache, several answers can share a key
+    return graded, timings, cache, sum(task[-1] is not None for task in tasks)
+
+
+def _write_corrections(correction_folder, files, headers, graded, store, read_answers, verbose=True):
+    """Write one correction file per question.
+
+    headers holds the name and mec of each exam, the students are ordered
+    by them. read_answers(exam number) returns the (question id, answer)
+    pairs of an exam; they are only needed for one exam at a time. Each
+    correction is written as soon as it is formatted and results are
+    removed from graded as they are written. The correct answers are read
+    from the store here, the results do not carry them.
+
+    Returns the points of every question found and a count of exams by the
+    number of questions graded in them.
+    """
+    order = sorted(range(len(headers)), key=lambda exam_no: headers[exam_no])
+
+    point_matrix = collections.defaultdict(list)
+    lengths = collections.Counter()
+    with contextlib.ExitStack() as stack:
+        outputs = []
+        for exam_no in order:
+            name_from_header, mec_from_header = headers[exam_no]
+            answers = read_answers(exam_no)
+            if verbose:
+                print(files[exam_no])
+            written = 0
+            for question_no, (id, answer) in enumerate(answers):
+                if (exam_no, question_no) not in graded:
+                    if verbose:
+                        print("\tquestion {} skipped".format(question_no+1))
+                    continue
+                module, points, grade, comment = graded.pop((exam_no, question_no))[:4]
+                if verbose:
+                    print("\t{} points {}".format(module, points))
+                point_matrix[question_no].append(points)
+                if written == len(outputs):
+                    os.makedirs(correction_folder, exist_ok=True)
+                    path = os.path.join(correction_folder, "question{0:03d}.txt".format(written+1))
+                    outputs.append(stack.enter_context(open(path, "w", encoding="utf-8", newline="")))
+                outputs[written].write(_crlf(_correction(question_no, points, name_from_header, mec_from_header,
+                                                         store[str(id)].correct_answer, answer, grade, comment)))
+                written += 1
+            lengths[written] += 1
+
+    return point_matrix, lengths
+
+
+def _profile_report(timings):
+    """A table of the grading time and memory of each question module,
+    most expensive first.
+    """
+    modules = collections.defaultdict(list)
+    for module, question_no, exam_no, id, seconds, cpu_seconds, peak in timings:
+        modules[module].append((seconds, cpu_seconds, peak))
+    lines = ["{:<40} {:>8} {:>10} {:>10} {:>10} {:>10} {:>10} {:>10}".format(
+             "module", "answers", "wall(s)", "mean(ms)", "max(ms)", "cpu(s)", "peak(MB)", "mean(MB)")]
+    for module, rows in sorted(modules.items(), key=lambda item: -sum(row[0] for row in item[1])):
+        seconds = [row[0] for row in rows]
+        cpu_seconds = [row[1] for row in rows if row[1] is not None]
+        peaks = [row[2] / 2**20 for row in rows if row[2] is not None] or [0]
+        lines.append("{:<40} {:>8} {:>10.2f} {:>10.1f} {:>10.1f} {:>10.2f} {:>10.1f} {:>10.1f}".format(
+                     module, len(rows), sum(seconds), 1000*sum(seconds)/len(seconds), 1000*max(seconds),
+                     sum(cpu_seconds), max(peaks), sum(peaks)/len(peaks)))
+    return "\n".join(lines) + "\n"
+
+
+# number of exams correct_tests parses and grades at a time
+_GRADING_BATCH = 200
+
+
+def correct_tests(question_numbers, jobs=1, question_major=False, profile=False):
     settings_path = pathlib.Path("settings.py")
     vardict= {}       
     with open(settings_path) as f:
@@ -385,117 +1890,337 @@ def correct_tests(question_numbers):
     returned_exam_folder = vardict["returned_exam_folder"]
     shelf_folder         = vardict["shelf_folder"]        
     uuidpat              = vardict["uuidpat"]             
-    endseparator         = vardict["endseparator"]        
     correction_folder    = vardict["correction_folder"]  
+    grading_timeout      = vardict.get("grading_timeout", 0)
+    grading_memory_limit = vardict.get("grading_memory_limit", 0)
     
     now = time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime())
     
     correction_folder = correction_folder + "_" + now
     
     # all files ending with md5.txt or .TXT
-    files  = sorted([f for f in sorted(os.listdir(returned_exam_folder)) if re.search("_([a-fA-F\d]{32})\.(txt|TXT)$",f)])
+    files  = sorted([f for f in sorted(os.listdir(returned_exam_folder)) if _MD5_FILENAME.search(f)])
     
     print("{} files out of {} in {} identified".format(len(files), len(os.listdir(returned_exam_folder)), returned_exam_folder))
     
     #import sys;sys.exit(42)
     
-    shelf  = shelve.open(str(pathlib.Path(shelf_folder)/"shelf.shelf"))
-    matrix = collections.defaultdict(list)
-    point_matrix = collections.defaultdict(list)
+    store  = open_question_store(shelf_folder, cache_size=1024)
     
     #files = [f for f in sorted(os.listdir(returned_exam_folder)) if f.endswith(("c00f675244144ebcc4fcaa28ca16fbeb.txt"))]
     
-    names=[]
-    
-    for f in files:
-        print(f)
-        with open(os.path.join(returned_exam_folder,f), "rb") as f:
-            test = f.read()
-        encoding = chardet.detect(test)["encoding"]
-        test = test.decode(encoding)
-
-        #test = codecs.open(os.path.join(returned_exam_folder,f),"r","utf8").read()
-        header, rest = re.split(uuidpat,test, maxsplit=1)
-        rest = rest.split(endseparator)[0]
-        name_from_header = re.search("(Name|Nome)(.*?)$",header,re.M).group(2).strip()
-        mec_from_header  = re.search("^(Número mecanográfico \(mec\))(.*?)$",header,re.M).group(2).strip()
-        exame = list((f.group(1),f.group(2)) for f in re.finditer("({uuidpat})(.*?)(?=({uuidpat}|$))".format(uuidpat=uuidpat),test,re.DOTALL))
-        
-        names.append((name_from_header, mec_from_header,))
-    
-        for question_no, (id, answer) in enumerate(exame):
-    
-            if question_numbers and not str(question_no+1) in question_numbers:
-                print("\tquestion {} skipped".format(question_no+1))
-                continue
-    
-            questionobj = shelf[str(id)]
-            print("\t{} points {}".format(questionobj.__class__.__module__, questionobj.points))
-            grade, comment = questionobj.correct(answer)
-            point_matrix[question_no].append(questionobj.points)
-            matrix[mec_from_header].append(textwrap.dedent('''
-                    {sep1}
-                    {correct_answer}
-                    {sep2}
-                    {students_answer}
-                    {sep3}
-    
-                    automatic comments:
-                    {comment}
-                    manual comment:
-    
-                    question..........: {question_no:03d}
-                    points............: {points}
-                    name..............: {name}
-                    mec...............: {mec}
-                    automatic grade(%): {grade}
-                    manual grade(%)...:
-                    {sep4}
-                    ''').format( question_no     = question_no+1,
-                                 points          = questionobj.points,
-                                 mec             = mec_from_header,
-                                 name            = name_from_header,
-                                 correct_answer  = questionobj.correct_answer,
-                                 students_answer = answer,
-                                 grade           = grade,
-                                 comment         = comment,
-                                 sep1            = "^"*(79-15)+" CORRECT ANSWER",
-                                 sep2            = "="*(79-16)+" students answer",
-                                 sep3            = "_"*(79-11)+" correction",
-                                 sep4            = "~"*79,
-                                 ))
-    
-    lengths=[]
-    
-    for key in sorted(matrix.keys()):
-        lengths.append(len(matrix[key]))
-    lengths = list(set(lengths))
-    
+    paths = [os.path.join(returned_exam_folder, f) for f in files]
+
+    # encodings found in earlier runs, by the md5 in the file name
+    encodings_path = pathlib.Path(shelf_folder) / "encodings.json"
+    encodings = json.loads(encodings_path.read_text()) if encodings_path.exists() else {}
+    checksums = [_MD5_FILENAME.search(f).group(1).lower() for f in files]
+    detections = collections.Counter()
+
+    pool = None
+    if grading_timeout or grading_memory_limit:
+        pool = GradingPool(shelf_folder, jobs, grading_timeout, grading_memory_limit)
+
+    executor = None
+    if jobs > 1 and pool is None:
+        # with a grading budget the answers are graded by the workers of the
+        # pool and the exams are parsed in this process
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=jobs,
+                                                          initializer=_init_correction_worker,
+                                                          initargs=(shelf_folder,))
+
+    mapper = executor.map if executor else map
+
+    # The exams are parsed and graded a batch at a time and only the name,
+    # mec and grades are kept. The answers are read again, one exam at a
+    # time, when the corrections are written.
+    headers = []
+    graded = {}
+    timings = []
+    cache = collections.Counter()
+    cached_grades = 0
+    answered = 0
+
+    for start in range(0, len(paths), _GRADING_BATCH):
+        batch = slice(start, start + _GRADING_BATCH)
+        parsed = mapper(_parse_exam, paths[batch], itertools.repeat(uuidpat),
+                        [encodings.get(checksum) for checksum in checksums[batch]])
+        tasks = []
+        for exam_no, (checksum, exam) in enumerate(zip(checksums[batch], parsed), start):
+            name_from_header, mec_from_header, answers, (encoding, detection) = exam
+            encodings[checksum] = encoding
+            detections[detection] += 1
+            headers.append((name_from_header, mec_from_header))
+            for question_no, (id, answer) in enumerate(answers):
+                if not question_numbers or str(question_no+1) in question_numbers:
+                    tasks.append((question_no, exam_no, id, answer))
+
+        results, batch_timings, batch_cache, batch_cached = _grade_tasks(tasks, store, executor, jobs,
+                                                                         question_major, pool, profile)
+        graded.update(results)
+        timings.extend(batch_timings)
+        cache.update(batch_cache)
+        cached_grades += batch_cached
+        answered += len(tasks)
+
+    encodings_path.write_text(json.dumps(encodings, indent=1))
+
+    if executor:
+        executor.shutdown()
+    if pool:
+        pool.close()
+
+    flagged = sum(str(result[3]).startswith(_MANUAL_GRADING) for result in graded.values())
+    if flagged:
+        print(f"{flagged} answers over the grading budget, search the corrections for {_MANUAL_GRADING}")
+
+    print("encoding found by: " + ", ".join(f"{detection} {count}" for detection, count in detections.most_common()))
+
+    print("grade cache: {} answers graded before, {} graded now".format(cached_grades, answered - cached_grades))
+
+    lookups = cache["hits"] + cache["misses"]
+    print("question cache: {} hits, {} misses ({:.0%} hit rate)".format(cache["hits"], cache["misses"],
+                                                                         cache["hits"] / lookups if lookups else 0))
+    module_times = collections.defaultdict(list)
+    for module, question_no, exam_no, id, seconds, cpu_seconds, peak in timings:
+        module_times[module].append(seconds)
+    print("{:<50} {:>8} {:>10} {:>10}".format("module", "answers", "total(s)", "mean(ms)"))
+    for module, seconds in sorted(module_times.items(), key=lambda item: -sum(item[1])):
+        print("{:<50} {:>8} {:>10.2f} {:>10.1f}".format(module, len(seconds), sum(seconds), 1000*sum(seconds)/len(seconds)))
+    
+    if profile:
+        os.makedirs(correction_folder, exist_ok=True)
+        report = _profile_report(timings)
+        print(report)
+        pathlib.Path(correction_folder, "profile.txt").write_text(report)
+        raw = [{"module": module, "question": question_no+1, "file": files[exam_no], "id": id,
+                "seconds": seconds, "cpu_seconds": cpu_seconds, "peak_bytes": peak}
+               for module, question_no, exam_no, id, seconds, cpu_seconds, peak in timings]
+        pathlib.Path(correction_folder, "profile.json").write_text(json.dumps(raw, indent=1))
+        print(f"grading profile written to {correction_folder}")
+
+    def read_answers(exam_no):
+        return _parse_exam(paths[exam_no], uuidpat, encodings[checksums[exam_no]])[2]
+
+    point_matrix, lengths = _write_corrections(correction_folder, files, headers, graded, store, read_answers)
+
     if len(lengths) != 1: # The same number of questions found in all exams!
-        print(lengths)
+        print(sorted(lengths))
         input()
-    
-    length = lengths.pop()
-    
-    points=[]
+
     for key in point_matrix:
         point = list(set(point_matrix[key]))
         assert len(point) == 1
     
-    for q in range(length):
-    
-        text = "".join([matrix[key][q] for key in [m for n,m in sorted(names)]])
-        text = text.replace( '\r\n', '\n'   )
-        text = text.replace( '\n',   '\r\n' )
-    
-        os.makedirs(correction_folder, exist_ok=True)
-        codecs.open(os.path.join(correction_folder, "question{0:03d}.txt".format(q+1)),"w","utf-8").write(text)
-    
-    shelf.close()
+    store.close()
     input("press return")
     
 
-def generate_spreadsheet(correction_folder):
+def _folder_changes(folder, interval):
+    """Yields once at the start and then every time files were written to
+    or moved into folder.
+
+    Uses inotify through inotify_simple if it is installed. Otherwise the
+    folder is polled every interval seconds. Either way, a change is
+    reported once the folder has looked the same for a whole interval, so
+    that files still being copied are not read.
+    """
+    def snapshot():
+        files = {}
+        for entry in os.scandir(folder):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                # renamed or removed since the folder was listed, e.g. a
+                # download saved as .part and renamed when complete
+                continue
+            files[entry.name] = stat.st_size, stat.st_mtime_ns
+        return files
+    yield
+    try:
+        from inotify_simple import INotify, flags
+    except ImportError:
+        INotify = None
+    if INotify is not None:
+        with contextlib.closing(INotify()) as inotify:
+            inotify.add_watch(folder, flags.CLOSE_WRITE | flags.MOVED_TO | flags.MODIFY | flags.CREATE)
+            while True:
+                if inotify.read():
+                    previous = snapshot()
+                    while True:
+                        time.sleep(interval)
+                        inotify.read(timeout=0)
+                        current = snapshot()
+                        if current == previous:
+                            break
+                        previous = current
+                    yield
+    else:
+        reported = previous = snapshot()
+        while True:
+            time.sleep(interval)
+            current = snapshot()
+            if current == previous and current != reported:
+                reported = current
+                yield
+            previous = current
+
+
+def _try_parse_exam(path, uuidpat, encoding=None):
+    # for watch, which reports a returned exam it cannot parse and goes on
+    try:
+        return _parse_exam(path, uuidpat, encoding), None
+    except Exception as e:
+        return None, repr(e)
+
+
+def watch(jobs=1, interval=2.0):
+    settings_path = pathlib.Path("settings.py")
+    vardict= {}       
+    with open(settings_path) as f:
+        code = compile(f.read(), settings_path.name, 'exec')
+    exec(code, vardict)
+    
+    returned_exam_folder = vardict["returned_exam_folder"]
+    shelf_folder         = vardict["shelf_folder"]        
+    uuidpat              = vardict["uuidpat"]             
+    correction_folder    = vardict["correction_folder"] + "_watch"
+    grading_timeout      = vardict.get("grading_timeout", 0)
+    grading_memory_limit = vardict.get("grading_memory_limit", 0)
+
+    store  = open_question_store(shelf_folder, cache_size=1024)
+
+    encodings_path = pathlib.Path(shelf_folder) / "encodings.json"
+    encodings = json.loads(encodings_path.read_text()) if encodings_path.exists() else {}
+
+    pool = None
+    if grading_timeout or grading_memory_limit:
+        pool = GradingPool(shelf_folder, jobs, grading_timeout, grading_memory_limit)
+
+    executor = None
+    if jobs > 1 and pool is None:
+        # as in correct_tests, only one of the two sets of workers is started
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=jobs,
+                                                          initializer=_init_correction_worker,
+                                                          initargs=(shelf_folder,))
+    mapper = executor.map if executor else map
+
+    duplicate_policy     = vardict.get("duplicate_policy", "newest_mtime")
+
+    # everything graded so far, by file name; the correction files are
+    # rewritten from these whenever exams come or go
+    exams  = {}
+    graded = {}
+    # exams that could not be parsed or graded, with the error
+    failed = {}
+
+    print(f"watching {returned_exam_folder}, corrections in {correction_folder}, ctrl-c to stop")
+
+    try:
+        for change in _folder_changes(returned_exam_folder, interval):
+            try:
+                _rename_returned_exams(returned_exam_folder, shelf_folder, duplicate_policy)
+            except Exception as e:
+                print(f"renaming returned exams failed: {e!r}")
+            current = set(f for f in os.listdir(returned_exam_folder) if _MD5_FILENAME.search(f))
+            for f in set(failed) - current:
+                del failed[f]
+            new = sorted(current - set(exams) - set(failed))
+            # superseded and duplicate exams are moved out of the folder
+            gone = set(exams) - current
+            for f in gone:
+                del exams[f], graded[f]
+            if not new and not gone:
+                continue
+            checksums = [_MD5_FILENAME.search(f).group(1).lower() for f in new]
+            parsed = mapper(_try_parse_exam, [os.path.join(returned_exam_folder, f) for f in new],
+                            itertools.repeat(uuidpat), [encodings.get(checksum) for checksum in checksums])
+            tasks = []
+            for exam_no, (f, checksum, (exam, error)) in enumerate(zip(new, checksums, parsed)):
+                if error:
+                    print(f"\t{f} skipped, it could not be read: {error}")
+                    failed[f] = error
+                    continue
+                name_from_header, mec_from_header, answers, (encoding, detection) = exam
+                encodings[checksum] = encoding
+                exams[f] = name_from_header, mec_from_header, answers
+                graded[f] = {}
+                for question_no, (id, answer) in enumerate(answers):
+                    tasks.append((question_no, exam_no, id, answer))
+            encodings_path.write_text(json.dumps(encodings, indent=1))
+
+            try:
+                results, timings, cache, cached_grades = _grade_tasks(tasks, store, executor, jobs, pool=pool)
+            except Exception:
+                # grade the new exams one by one, skipping those that fail
+                results, cached_grades = {}, 0
+                for exam_no, f in enumerate(new):
+                    if f in failed:
+                        continue
+                    try:
+                        exam_results, timings, cache, exam_cached = _grade_tasks([task for task in tasks if task[1] == exam_no],
+                                                                                 store, executor, jobs, pool=pool)
+                    except Exception as e:
+                        print(f"\t{f} skipped, it could not be graded: {e!r}")
+                        failed[f] = repr(e)
+                        del exams[f], graded[f]
+                    else:
+                        results.update(exam_results)
+                        cached_grades += exam_cached
+            for (exam_no, question_no), result in results.items():
+                graded[new[exam_no]][question_no] = result
+
+            files = sorted(exams)
+            point_matrix, lengths = _write_corrections(correction_folder, files, [exams[f][:2] for f in files],
+                                                       {(exam_no, question_no): result
+                                                        for exam_no, f in enumerate(files)
+                                                        for question_no, result in graded[f].items()},
+                                                       store, lambda exam_no: exams[files[exam_no]][2], verbose=False)
+
+            print("{} {} new exams ({} answers, {} graded before), {} gone, {} exams in {}".format(
+                  time.strftime("%H:%M:%S"), len(set(new) - set(failed)), len(tasks), cached_grades, len(gone), len(files), correction_folder))
+            if len(lengths) != 1:
+                print("\tnot the same number of questions in all exams: {}".format(sorted(lengths)))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if executor:
+            executor.shutdown()
+        if pool:
+            pool.close()
+        store.close()
+
+
+def invalidate_grades(modules):
+    settings_path = pathlib.Path("settings.py")
+    vardict= {}       
+    with open(settings_path) as f:
+        code = compile(f.read(), settings_path.name, 'exec')
+    exec(code, vardict)
+    shelf_folder         = vardict["shelf_folder"]        
+
+    with open_question_store(shelf_folder) as store:
+        for module in modules:
+            print(f"{module}: {store.invalidate_grades(module)} cached grades removed")
+
+
+_GRADE_RECORD = re.compile(r"question\.{10}:\s*([\d.,]+)\s*"
+                           r"points\.{12}:\s*([\d.,]+)\s*"
+                           r"name\.{14}:(.*)\s*"
+                           r"mec\.{15}:\s*([A-Za-z\d]+)\s*"
+                           r"automatic grade\(%\):\s*([\d.,]+)\s*"
+                           r"manual grade\(%\)\.{3}:(?:\s*([\d.,]+))?")
+
+
+def _parse_correction_file(path):
+    """The question number, points, name, mec, automatic grade and manual
+    grade (None if there is none) of every correction in a correction file.
+    """
+    with open(path, encoding="utf-8") as f:
+        return [match.groups() for match in _GRADE_RECORD.finditer(f.read())]
+
+
+def generate_spreadsheet(correction_folder, jobs=1):
    
     now = time.strftime("%Y-%m-%d %H_%M_%S", time.localtime())
     
@@ -503,13 +2228,6 @@ def generate_spreadsheet(correction_folder):
     
     rmat = collections.defaultdict(dict)
     
-    grade =(Literal("question..........:").suppress() + Word(nums+"."+",").setResultsName("Q#") +
-            Literal("points............:").suppress() + Word(nums+"."+",").setResultsName("points") +
-            Literal("name..............:").suppress() + restOfLine.setResultsName("name") +
-            Literal("mec...............:").suppress() + Word(alphanums).setResultsName("mec") +
-            Literal("automatic grade(%):").suppress() + Word(nums+"."+",").setResultsName("autgrade") +
-            Literal("manual grade(%)...:").suppress() + Optional(Word(nums+"."+",")).setResultsName("mangrade"))
-    
     question_number_list = []
     name_list            = []
     points               = []
@@ -517,25 +2235,31 @@ def generate_spreadsheet(correction_folder):
     
     names=[]
     
-    for file_ in files:
+    paths = [os.path.join(correction_folder, file_) for file_ in files]
+    if jobs > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+            records = list(executor.map(_parse_correction_file, paths))
+    else:
+        records = map(_parse_correction_file, paths)
+
+    for file_, file_records in zip(files, records):
         weight=[]
         print("processing: ", file_)
-        content = open(os.path.join(correction_folder, file_),"r").read()
-        for data, dataStart, dataEnd in grade.scanString(content):
-            name = str(data["name"].strip())
+        for question_no, points_, name, mec, autgrade, mangrade in file_records:
+            name = name.strip()
             try:
-                mec  = int(data["mec"])
+                mec  = int(mec)
             except ValueError:
-                mec  = str(data["mec"])
+                pass
             if not rmat[mec]:
                 rmat[mec] = [name, mec]
                 names.append((name, mec))
-            question_number_list.append(data["Q#"])
-            weight.append(data["points"])
-            if "mangrade" in data:
-                rmat[mec].append(float( data["mangrade"]))
+            question_number_list.append(question_no)
+            weight.append(points_)
+            if mangrade is not None:
+                rmat[mec].append(float( mangrade))
             else:
-                rmat[mec].append(float( data["autgrade"]))
+                rmat[mec].append(float( autgrade))
         points.extend(list(set(weight)))
     
     
@@ -594,17 +2318,30 @@ def main():
     elif arguments['parse_students']:
         parse_students(arguments["<path_student_list_file>"])
         
+    elif arguments['pregenerate_pool']:
+        pregenerate_pool(int(arguments["<n>"]))
+
     elif arguments['generate_tests']:        
-        generate_tests()
+        generate_tests(int(arguments["--jobs"]), arguments["--metrics-json"], arguments["--force"])
         
+    elif arguments['rerender_tests']:
+        rerender_tests()
+
     elif arguments['rename_completed_tests']:
         rename_completed_tests()      
         
     elif arguments['correct_tests']:
-        correct_tests(arguments["<question_numbers>"])
+        correct_tests(arguments["<question_numbers>"], int(arguments["--jobs"]), arguments["--question-major"],
+                      arguments["--profile"])
         
+    elif arguments['watch']:
+        watch(int(arguments["--jobs"]), float(arguments["--interval"]))
+
+    elif arguments['invalidate_grades']:
+        invalidate_grades(arguments["<module>"])
+
     elif arguments['generate_spreadsheet']:
-        generate_spreadsheet(arguments["<correction_folder>"])
+        generate_spreadsheet(arguments["<correction_folder>"], int(arguments["--jobs"]))
 
 
 if __name__ == '__main__':
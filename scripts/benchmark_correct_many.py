@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Grade a synthetic class with one correct() call per answer and with the
+correct_many() batch protocol of correct_tests.
+
+The synthetic question compares a pasted sequence with the correct one.
+Like the pydna based graders, every correct() call has to prepare the
+reference (here: parse it and build its k-mer index), while correct_many()
+prepares it once for all answers to the same variant and compares all
+answers in one sweep.
+
+Usage: benchmark_correct_many.py [<students>] [<variants>]
+"""
+
+import re
+import sys
+import time
+import random
+
+from bio_info_test.informatics_test import _grade_answers
+
+students = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+variants = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+
+k = 8
+
+
+def prepare(reference):
+    sequence = re.sub("[^acgt]", "", reference.lower())
+    return {sequence[i:i+k] for i in range(len(sequence) - k + 1)}
+
+
+def score(kmers, answer):
+    sequence = re.sub("[^acgt]", "", answer.lower())
+    found = sum(sequence[i:i+k] in kmers for i in range(0, len(sequence) - k + 1, k))
+    return round(100 * found / max(1, len(sequence) // k))
+
+
+class question(object):
+    def __init__(self, points):
+        self.points = points
+        self.id = str(len(store.questions))
+        sequence = "".join(random.choice("acgt") for i in range(5000))
+        self.correct_answer = "\n".join(sequence[i:i+60] for i in range(0, len(sequence), 60))
+
+    def correct(self, answer):
+        grade = score(prepare(self.correct_answer), answer)
+        return grade, f"{grade}% of the sequence found"
+
+
+class batch_question(question):
+    @classmethod
+    def correct_many(cls, pairs):
+        prepared = {}
+        grades = []
+        for questionobj, answer in pairs:
+            if questionobj.id not in prepared:
+                prepared[questionobj.id] = prepare(questionobj.correct_answer)
+            grade = score(prepared[questionobj.id], answer)
+            grades.append((grade, f"{grade}% of the sequence found"))
+        return grades
+
+
+class store(object):
+    # stands in for the QuestionStore
+    questions = {}
+    hits = misses = 0
+
+    def __getitem__(self, id):
+        return self.questions[id]
+
+
+random.seed(42)
+store = store()
+results = {}
+for cls in (question, batch_question):
+    random.seed(42)
+    store.questions.clear()
+    for n in range(variants):
+        questionobj = cls(2)
+        store.questions[questionobj.id] = questionobj
+    answers = []
+    for n in range(students):
+        questionobj = store.questions[str(n % variants)]
+        answer = questionobj.correct_answer if n % 4 else questionobj.correct_answer[::-1]
+        answers.append((questionobj.id, answer))
+    start = time.perf_counter()
+    graded, cache = _grade_answers(answers, store)
+    elapsed = time.perf_counter() - start
+    results[cls.__name__] = [result[2:4] for result in graded]
+    print(f"{cls.__name__:<15}: {elapsed:8.3f} s  {1000*elapsed/students:8.2f} ms/answer")
+
+assert results["question"] == results["batch_question"]
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Time reading the name, mec and md5 of returned exams the way
+rename_completed_tests did before (the whole file decoded and scanned with
+two pyparsing grammars) and with _read_exam_header, on a folder of large
+synthetic submissions. The old way needs seconds per megabyte, so it is
+only timed on the first <old_files> files.
+
+Usage: benchmark_rename.py [<files>] [<megabytes_per_file>] [<old_files>]
+"""
+
+import re
+import sys
+import time
+import codecs
+import random
+import shutil
+import pathlib
+import tempfile
+from hashlib import md5
+
+from pyparsing import Literal, LineEnd, SkipTo
+
+from bio_info_test.informatics_test import _read_exam_header
+
+files = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+megabytes = float(sys.argv[2]) if len(sys.argv) > 2 else 1.0
+old_files = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+
+
+def old_read(path):
+    handle = codecs.open(path, "rb", "latin-1")
+    exam = handle.read()
+    handle.close()
+    md5_ = md5(exam.encode("latin-1")).hexdigest()
+    name = (Literal("Nome") + SkipTo(LineEnd()).setResultsName("name"))
+    id = (Literal("(mec)") + SkipTo(LineEnd()).setResultsName("mec"))
+    for data, dataStart, dataEnd in name.scanString(exam):
+        parsed_student_name = data["name"].strip()
+    for data, dataStart, dataEnd in id.scanString(exam):
+        parsed_mec = data["mec"].strip().lower()
+    return parsed_student_name, parsed_mec, md5_
+
+
+random.seed(42)
+folder = pathlib.Path(tempfile.mkdtemp())
+sequence = "".join(random.choice("ACGT") for i in range(100000))
+body = "\r\n".join(sequence[i:i+70] for i in range(0, len(sequence), 70))
+body = (body * (int(megabytes * 1e6) // len(body) + 1))[:int(megabytes * 1e6)]
+for n in range(files):
+    header = ("=" * 80 + "\r\nBMA19 | Unix timestamp 1576152000\r\n"
+              f"Nome                       Student Número {n}\r\n"
+              f"Número mecanográfico (mec) A{10000 + n}        \r\n" + "=" * 80 + "\r\n")
+    (folder / f"exam_{n}.txt").write_bytes((header + body[n:]).encode("latin-1"))
+
+paths = sorted(folder.iterdir())
+print(f"{files} files of {megabytes} MB")
+
+start = time.perf_counter()
+before = [old_read(path) for path in paths[:old_files]]
+elapsed = time.perf_counter() - start
+print(f"codecs + pyparsing : {elapsed:8.2f} s  {1000*elapsed/old_files:8.2f} ms/file ({old_files} files)")
+
+start = time.perf_counter()
+after = [_read_exam_header(path) for path in paths]
+elapsed = time.perf_counter() - start
+print(f"_read_exam_header  : {elapsed:8.2f} s  {1000*elapsed/files:8.2f} ms/file")
+
+assert before == after[:old_files]
+
+shutil.rmtree(folder)
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Per student cost of rendering an exam, with the string concatenation and
+re.sub that generate_tests used before and with ExamTemplate.
+
+Usage: benchmark_render.py [<students>] [<questions>]
+"""
+
+import re
+import sys
+import time
+import uuid
+import random
+
+from bio_info_test.informatics_test import ExamTemplate
+
+students = int(sys.argv[1]) if len(sys.argv) > 1 else 400
+number_of_questions = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+header = """================================================================================
+BMA19 | Biologia Molecular Aplicada 9505N3 | 2019-12-12 | Unix timestamp {timestamp}
+Nome                       {name}
+Número mecanográfico (mec) {mec}
+================================================================================
+""" + "Instructions: fill in your answers where you find the ? symbol(s).\n" * 25
+question_separator = "\n*********** Question {} ***********\n"
+endseparator = "\n========== end of exame ========================================================"
+
+
+class question(object):
+    def __init__(self):
+        self.id = str(uuid.uuid4())
+        sequence = "".join(random.choice("acgt") for i in range(2000))
+        text = "\n".join(sequence[i:i+60] for i in range(0, len(sequence), 60))
+        self.empty_question = f"{self.id}\n{text}\nanswer: ?\n"
+        self.correct_answer = f"{self.id}\n{text}\nanswer: 42\n"
+
+
+def render(name, mec, timestamp, q):
+    empty_exam = header.format(name=name, mec=mec, timestamp=timestamp,
+                               question_separator=question_separator,
+                               number_of_questions=len(q))
+    correct_exam = empty_exam
+    for index, question in enumerate(q):
+        empty_exam += question_separator.format(index+1)
+        correct_exam += question_separator.format(index+1)
+        empty_exam += question.empty_question
+        correct_exam += question.correct_answer
+    empty_exam += endseparator
+    correct_exam += endseparator
+    empty_exam = re.sub("\r?\n", "\r\n", empty_exam)
+    correct_exam = re.sub("\r?\n", "\r\n", correct_exam)
+    return empty_exam, correct_exam
+
+
+random.seed(42)
+exams = [[question() for n in range(number_of_questions)] for s in range(students)]
+
+start = time.perf_counter()
+before = [render("Max Maximus", "99999", 0, q) for q in exams]
+elapsed_before = time.perf_counter() - start
+
+start = time.perf_counter()
+template = ExamTemplate(header, question_separator, endseparator, [])
+after = [template.render("Max Maximus", "99999", 0, q) for q in exams]
+elapsed_after = time.perf_counter() - start
+
+assert before == after
+
+print(f"{students} students, {number_of_questions} questions, exam size {len(after[0][0])} characters")
+print(f"concatenation + re.sub : {1e6*elapsed_before/students:8.1f} us/student")
+print(f"ExamTemplate           : {1e6*elapsed_after/students:8.1f} us/student")
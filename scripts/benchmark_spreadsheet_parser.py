@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Time reading the grades of a correction folder with the pyparsing grammar
+that generate_spreadsheet used before and with _parse_correction_file,
+serially and in a process pool.
+
+The correction folder has one file per question with a correction for
+every student, each holding a pasted answer of <answer_kb> kB. pyparsing
+needs seconds per file, so the old way is only timed on the first
+<old_files> files.
+
+Usage: benchmark_spreadsheet_parser.py [<students>] [<questions>] [<answer_kb>] [<old_files>] [<jobs>]
+"""
+
+import os
+import sys
+import time
+import random
+import shutil
+import pathlib
+import tempfile
+import concurrent.futures
+
+from pyparsing import Literal, Word, nums, restOfLine, alphanums, Optional
+
+from bio_info_test.informatics_test import _correction, _crlf, _parse_correction_file
+
+students = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+questions = int(sys.argv[2]) if len(sys.argv) > 2 else 15
+answer_kb = float(sys.argv[3]) if len(sys.argv) > 3 else 5
+old_files = int(sys.argv[4]) if len(sys.argv) > 4 else 1
+jobs = int(sys.argv[5]) if len(sys.argv) > 5 else os.cpu_count()
+
+grade =(Literal("question..........:").suppress() + Word(nums+"."+",").setResultsName("Q#") +
+        Literal("points............:").suppress() + Word(nums+"."+",").setResultsName("points") +
+        Literal("name..............:").suppress() + restOfLine.setResultsName("name") +
+        Literal("mec...............:").suppress() + Word(alphanums).setResultsName("mec") +
+        Literal("automatic grade(%):").suppress() + Word(nums+"."+",").setResultsName("autgrade") +
+        Literal("manual grade(%)...:").suppress() + Optional(Word(nums+"."+",")).setResultsName("mangrade"))
+
+
+def old_parse(path):
+    content = open(path, "r", encoding="utf-8").read()
+    return [(data["Q#"], data["points"], data["name"], data["mec"], data["autgrade"],
+             data["mangrade"] if "mangrade" in data else None)
+            for data, dataStart, dataEnd in grade.scanString(content)]
+
+
+random.seed(42)
+folder = pathlib.Path(tempfile.mkdtemp())
+sequence = "".join(random.choice("acgt") for i in range(int(answer_kb * 1000)))
+answer = "\n".join(sequence[i:i+70] for i in range(0, len(sequence), 70))
+for q in range(questions):
+    with open(folder / "question{0:03d}.txt".format(q+1), "w", encoding="utf-8", newline="") as f:
+        for n in range(students):
+            f.write(_crlf(_correction(q, 2, f"Student Número {n}", f"a{10000 + n}", answer, answer[n:],
+                                      random.randint(0, 100), "comment")))
+paths = sorted(folder.iterdir())
+print(f"{students} students, {questions} questions, {paths[0].stat().st_size / 1e6:.1f} MB per file")
+
+start = time.perf_counter()
+before = [old_parse(path) for path in paths[:old_files]]
+elapsed = time.perf_counter() - start
+print(f"pyparsing scanString     : {1000*elapsed/old_files:10.1f} ms/file ({old_files} files)")
+
+start = time.perf_counter()
+after = [_parse_correction_file(path) for path in paths]
+elapsed = time.perf_counter() - start
+print(f"_parse_correction_file   : {1000*elapsed/questions:10.1f} ms/file")
+
+start = time.perf_counter()
+with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+    parallel = list(executor.map(_parse_correction_file, paths))
+elapsed = time.perf_counter() - start
+print(f"  in {jobs} processes{'':<7}: {1000*elapsed/questions:10.1f} ms/file")
+
+assert before == after[:old_files]
+assert parallel == after
+
+shutil.rmtree(folder)
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Time the parsing of returned exams with the regular expressions that
+correct_tests used before and with ExamTokenizer, on synthetic exams of
+about 1 MB.
+
+Usage: benchmark_tokenizer.py [<exams>] [<questions>]
+"""
+
+import re
+import sys
+import time
+import uuid
+import random
+
+from bio_info_test.informatics_test import ExamTokenizer
+
+exams = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+number_of_questions = int(sys.argv[2]) if len(sys.argv) > 2 else 15
+
+uuidpat = "[a-f0-9]{8}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{12}"
+endseparator = "\n========== end of exame ========================================================"
+
+
+def old_parse(test):
+    header, rest = re.split(uuidpat, test, maxsplit=1)
+    rest = rest.split(endseparator)[0]
+    name = re.search("(Name|Nome)(.*?)$", header, re.M).group(2).strip()
+    mec = re.search("^(Número mecanográfico \\(mec\\))(.*?)$", header, re.M).group(2).strip()
+    exame = list((f.group(1), f.group(2)) for f in re.finditer("({uuidpat})(.*?)(?=({uuidpat}|$))".format(uuidpat=uuidpat), test, re.DOTALL))
+    return name, mec, exame
+
+
+def new_parse(tokenizer, test):
+    name, mec, spans = tokenizer.tokenize(test)
+    return name, mec, list(tokenizer.answers(test, spans))
+
+
+random.seed(42)
+texts = []
+for n in range(exams):
+    parts = ["=" * 80 + "\r\nBMA19 | Unix timestamp 1576152000\r\n",
+             f"Nome                       Student {n}\r\n",
+             f"Número mecanográfico (mec) a{10000 + n}\r\n" + "=" * 80 + "\r\n"]
+    for q in range(number_of_questions):
+        parts.append(f"\r\n*********** Question {q + 1} ***********\r\n")
+        parts.append(str(uuid.uuid4()) + "\r\n")
+        answer = "".join(random.choice("ACGT") for i in range(1000000 // number_of_questions))
+        parts.append("\r\n".join(answer[i:i+70] for i in range(0, len(answer), 70)))
+    parts.append(endseparator.replace("\n", "\r\n"))
+    if n % 2:
+        parts.append("\r\n")
+    texts.append("".join(parts))
+
+start = time.perf_counter()
+before = [old_parse(text) for text in texts]
+elapsed_before = time.perf_counter() - start
+
+start = time.perf_counter()
+tokenizer = ExamTokenizer(uuidpat)
+after = [new_parse(tokenizer, text) for text in texts]
+elapsed_after = time.perf_counter() - start
+
+assert before == after
+
+print(f"{exams} exams of {len(texts[0]) / 1e6:.2f} MB with {number_of_questions} questions")
+print(f"regular expressions : {1000*elapsed_before/exams:8.2f} ms/exam")
+print(f"ExamTokenizer       : {1000*elapsed_after/exams:8.2f} ms/exam")
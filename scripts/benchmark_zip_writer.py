@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compare the time needed to archive the exams of a class with the 7za
+subprocess (the old generate_tests path) and with the in-process
+write_encrypted_zip.
+
+Every archive holds the exam text and three GenBank files, the size of the
+plasmids usually included in the exams (pUC19, a YEp352 sized shuttle vector
+and a 15 kb cosmid). A real 7-Zip is needed, 7za from p7zip or 7zz from
+7-Zip for Linux, which take the same arguments. It is looked up in PATH
+unless given as the second argument.
+
+Usage: benchmark_zip_writer.py [<students>] [<path_to_7za>]
+"""
+
+import sys
+import time
+import random
+import shutil
+import pathlib
+import tempfile
+import textwrap
+import subprocess
+
+from bio_info_test.informatics_test import write_encrypted_zip
+
+students = int(sys.argv[1]) if len(sys.argv) > 1 else 400
+sevenza = sys.argv[2] if len(sys.argv) > 2 else shutil.which("7za") or shutil.which("7zz")
+password = "abc12"
+
+if not sevenza:
+    sys.exit("7za or 7zz was not found, install 7-Zip or give its path as the second argument.")
+
+random.seed(42)
+
+
+def genbank(name, length):
+    sequence = "".join(random.choice("acgt") for i in range(length))
+    lines = [f"LOCUS       {name:<16}{length:>11} bp    DNA     circular SYN 18-OCT-2026",
+             f"DEFINITION  {name} cloning vector.",
+             f"ACCESSION   {name}",
+             f"VERSION     {name}",
+             "KEYWORDS    .",
+             "SOURCE      synthetic DNA construct",
+             "  ORGANISM  synthetic DNA construct",
+             "FEATURES             Location/Qualifiers",
+             f"     source          1..{length}",
+             '                     /mol_type="other DNA"',
+             '                     /organism="synthetic DNA construct"']
+    start = 1
+    while start + 1200 < length:
+        end = start + random.randrange(300, 1200)
+        lines += [f"     CDS             {start}..{end}",
+                  f'                     /gene="orf{start}"',
+                  f'                     /label="orf{start}"']
+        translation = "".join(random.choice("ACDEFGHIKLMNPQRSTVWY") for i in range((end - start) // 3))
+        lines += textwrap.wrap(f'/translation="{translation}"', 58,
+                               initial_indent=" " * 21, subsequent_indent=" " * 21)
+        start = end + random.randrange(50, 400)
+    lines.append("ORIGIN")
+    for i in range(0, length, 60):
+        chunk = sequence[i:i + 60]
+        lines.append(f"{i + 1:>9} " + " ".join(chunk[j:j + 10] for j in range(0, len(chunk), 10)))
+    lines.append("//")
+    return "\r\n".join(lines).encode()
+
+
+included = {"pUC19.gb": genbank("pUC19", 2686),
+            "YEp352.gb": genbank("YEp352", 5181),
+            "pWEB.gb": genbank("pWEB", 15112)}
+words = "the primer pcr product sequence vector insert answer question fragment".split()
+
+
+def exam_text():
+    text = []
+    while sum(len(t) for t in text) < 30000:
+        text.append(" ".join(random.choice(words) for i in range(12)))
+        text.append("".join(random.choice("ACGT") for i in range(70)))
+    return "\r\n".join(text).encode("latin-1")
+
+
+exams = [exam_text() for n in range(students)]
+
+workdir = pathlib.Path(tempfile.mkdtemp())
+out = workdir / "out"
+out.mkdir()
+
+print(f"{students} students, exam size {len(exams[0])} bytes, "
+      f"included files {', '.join(f'{name} {len(data)} bytes' for name, data in included.items())}")
+print(subprocess.run([sevenza], stdout=subprocess.PIPE, text=True).stdout.strip().splitlines()[0])
+
+start = time.perf_counter()
+for n, exam in enumerate(exams):
+    stage = workdir / "exam"
+    if stage.exists():
+        shutil.rmtree(stage)
+    stage.mkdir()
+    for name, data in included.items():
+        (stage / name).write_bytes(data)
+    (stage / f"test_{n}.txt").write_bytes(exam)
+    subprocess.call(f'{sevenza} a -tzip "{workdir}/{n}.zip" {stage}/* -p{password} -scrcSHA256',
+                    shell=True, stdout=subprocess.DEVNULL)
+    shutil.move(f"{workdir}/{n}.zip", out)
+elapsed = time.perf_counter() - start
+print(f"7za subprocess      : {elapsed:8.3f} s  {1000*elapsed/students:8.2f} ms/student")
+
+shutil.rmtree(out)
+out.mkdir()
+
+start = time.perf_counter()
+for n, exam in enumerate(exams):
+    write_encrypted_zip(out / f"{n}.zip", [*included.items(), (f"test_{n}.txt", exam)], password)
+elapsed = time.perf_counter() - start
+print(f"write_encrypted_zip : {elapsed:8.3f} s  {1000*elapsed/students:8.2f} ms/student")
+
+shutil.rmtree(workdir)
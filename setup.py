@@ -28,7 +28,9 @@ setup(  name='bio_info_test',
         long_description=long_description,
         long_description_content_type='text/markdown',
         
-        install_requires = [ "pydna", "docopt", "pyparsing", "ezodf"],
+        install_requires = [ "pydna", "docopt", "ezodf"],
+        
+        python_requires = ">=3.7",
 
         zip_safe = False,
         keywords = u"bioinformatics",
@@ -37,7 +39,6 @@ setup(  name='bio_info_test',
                        'Intended Audience :: Education',
                        'Intended Audience :: Science/Research',
                        'License :: OSI Approved :: BSD License',
-                       'Programming Language :: Python :: 3.6',
                        'Programming Language :: Python :: 3.7',
                        'Topic :: Education',
                        'Topic :: Scientific/Engineering :: Bio-Informatics',])
\ No newline at end of file
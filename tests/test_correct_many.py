@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from bio_info_test.informatics_test import _grade_answers
+
+
+class question(object):
+    def __init__(self, id):
+        self.id = id
+        self.points = 1
+        self.correct_answer = "42"
+
+    @classmethod
+    def correct_many(cls, pairs):
+        return [(int(answer == questionobj.correct_answer), "") for questionobj, answer in pairs]
+
+
+class short_question(question):
+    @classmethod
+    def correct_many(cls, pairs):
+        return [(1, "")] * (len(pairs) - 1)
+
+
+class store(dict):
+    # stands in for the QuestionStore
+    hits = misses = 0
+
+
+def test_correct_many_grades_every_answer():
+    questions = store(q1=question("q1"))
+    results, cache = _grade_answers([("q1", "42"), ("q1", "41")], questions)
+    assert [result[2] for result in results] == [1, 0]
+
+
+def test_correct_many_returning_too_few_grades_is_an_error():
+    questions = store(q1=short_question("q1"))
+    with pytest.raises(ValueError, match="short_question.correct_many returned 1 grades for 2 answers"):
+        _grade_answers([("q1", "42"), ("q1", "41")], questions)
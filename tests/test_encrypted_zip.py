@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import stat
+import zipfile
+import zlib
+
+import pytest
+
+from bio_info_test.informatics_test import write_encrypted_zip
+
+
+included = b"LOCUS       pUC19   2686 bp    DNA     circular\r\nORIGIN\r\n" + os.urandom(3000).hex().encode()
+
+
+def test_archive_opens_with_the_password(tmp_path):
+    members = [("pUC19.gb", included), ("test_Ana_a12345.txt", "Nome Ana\r\nação\r\n".encode("latin-1")),
+               ("resumé.txt", b"")]
+    write_encrypted_zip(tmp_path / "exam.zip", members, "abc12")
+
+    assert not (tmp_path / "exam.zip.part").exists()
+    with zipfile.ZipFile(tmp_path / "exam.zip") as archive:
+        for info, (name, data) in zip(archive.infolist(), members):
+            assert info.filename == name
+            assert info.flag_bits & 0x1
+            assert stat.S_ISREG(info.external_attr >> 16)
+            assert stat.S_IMODE(info.external_attr >> 16) == 0o644
+            assert archive.read(name, pwd=b"abc12") == data
+
+
+def test_shared_members_are_the_same_in_every_archive(tmp_path):
+    for n in range(2):
+        write_encrypted_zip(tmp_path / f"{n}.zip", [("pUC19.gb", included), (f"test_{n}.txt", str(n).encode())], "abc12")
+    for n in range(2):
+        with zipfile.ZipFile(tmp_path / f"{n}.zip") as archive:
+            assert archive.read("pUC19.gb", pwd=b"abc12") == included
+            assert archive.read(f"test_{n}.txt", pwd=b"abc12") == str(n).encode()
+
+
+def test_wrong_password_fails(tmp_path):
+    write_encrypted_zip(tmp_path / "exam.zip", [("pUC19.gb", included)], "abc12")
+    with zipfile.ZipFile(tmp_path / "exam.zip") as archive:
+        with pytest.raises(RuntimeError):
+            archive.read("pUC19.gb")
+        # the check byte of the encryption header lets about 1 in 256 wrong
+        # passwords through, those fail on the data instead
+        with pytest.raises((RuntimeError, zipfile.BadZipFile, zlib.error)):
+            archive.read("pUC19.gb", pwd=b"abc13")
@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from bio_info_test.informatics_test import QuestionStore, _grade_tasks
+
+
+class question(object):
+    def __init__(self, id):
+        self.id = id
+        self.points = 1
+        self.correct_answer = "42"
+
+    def correct(self, answer):
+        return int(answer.strip() == self.correct_answer), ""
+
+
+def test_cached_answers_are_counted_not_keys(tmp_path):
+    store = QuestionStore(tmp_path / "questions.sqlite")
+    store["q1"] = question("q1")
+    # three students gave the same answer, they share one cache key
+    tasks = [(0, exam_no, "q1", answer) for exam_no, answer in enumerate(["42", "42", "42", "41"])]
+
+    graded, timings, cache, cached = _grade_tasks(tasks, store)
+    assert cached == 0
+    assert len(timings) == 4
+
+    graded, timings, cache, cached = _grade_tasks(tasks, store)
+    assert cached == 4
+    assert timings == []
+    assert graded[0, 0][2] == graded[2, 0][2] == 1
+    assert graded[3, 0][2] == 0
+    store.close()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+from hashlib import md5
+
+from bio_info_test.informatics_test import _recover_renames, _apply_renames, _rename_returned_exams
+
+
+def make_folders(tmp_path, files, renames):
+    folder = tmp_path / "returned_exams"
+    shelf = tmp_path / "shelf"
+    folder.mkdir()
+    shelf.mkdir()
+    for name in files:
+        (folder / name).write_text(name)
+    (shelf / "rename_journal.json").write_text(json.dumps(renames))
+    return folder, shelf
+
+
+def test_interrupted_renames_are_resumed(tmp_path):
+    renames = [["a.txt", "A_1_md5.txt"], ["b.txt", "B_2_md5.txt"], ["c.txt", "duplicates/c.txt"]]
+    # the crash came after the first rename
+    folder, shelf = make_folders(tmp_path, ["A_1_md5.txt", "b.txt", "c.txt"], renames)
+
+    _recover_renames(str(folder), str(shelf))
+
+    assert sorted(p.relative_to(folder).as_posix() for p in folder.rglob("*.txt")) == ["A_1_md5.txt",
+                                                                                      "B_2_md5.txt",
+                                                                                      "duplicates/c.txt"]
+    assert (folder / "B_2_md5.txt").read_text() == "b.txt"
+    assert not (shelf / "rename_journal.json").exists()
+
+
+def test_interrupted_renames_are_rolled_back(tmp_path):
+    renames = [["a.txt", "A_1_md5.txt"], ["b.txt", "B_2_md5.txt"], ["gone.txt", "G_3_md5.txt"]]
+    # gone.txt was removed after the renames were planned
+    folder, shelf = make_folders(tmp_path, ["A_1_md5.txt", "b.txt"], renames)
+
+    _recover_renames(str(folder), str(shelf))
+
+    assert sorted(p.name for p in folder.iterdir()) == ["a.txt", "b.txt"]
+    assert (folder / "a.txt").read_text() == "A_1_md5.txt"
+    assert not (shelf / "rename_journal.json").exists()
+
+
+def test_renames_onto_existing_files_are_reported(tmp_path, capsys):
+    folder, shelf = make_folders(tmp_path, ["a.txt", "A_1_md5.txt"], [])
+
+    _apply_renames(str(folder), [("a.txt", "A_1_md5.txt")])
+
+    assert (folder / "a.txt").read_text() == "a.txt"
+    assert (folder / "A_1_md5.txt").read_text() == "A_1_md5.txt"
+    assert "not renaming" in capsys.readouterr().out
+
+
+def test_duplicates_with_a_reused_name_are_kept_apart(tmp_path):
+    exam = "Nome                       Ana Silva\nNúmero mecanográfico (mec) a12345\n".encode("latin-1")
+    folder, shelf = make_folders(tmp_path, [], [])
+    (folder / f"Ana_Silva_a12345_{md5(exam).hexdigest()}.txt").write_bytes(exam)
+    (folder / "duplicates").mkdir()
+    (folder / "duplicates" / "test.txt").write_bytes(exam)
+    # the same attachment returned once more
+    (folder / "test.txt").write_bytes(exam)
+
+    _rename_returned_exams(str(folder), str(shelf))
+
+    assert sorted(p.relative_to(folder).as_posix() for p in folder.rglob("*.txt")) == [
+        f"Ana_Silva_a12345_{md5(exam).hexdigest()}.txt", "duplicates/test.txt", "duplicates/test_1.txt"]